@@ -0,0 +1,247 @@
+import array
+import asyncio
+import collections
+import contextlib
+import logging
+import threading
+
+import usb.core
+
+from modtpy.api.errors import PrinterError
+from modtpy.api.modt_commands import Endpoints, STATUS_REQUEST, RESPONSE_READ_SIZE, reply_id, response_complete
+
+# timeout of the reads of the reader tasks in ms, which bounds how long closing a channel takes
+READ_TIMEOUT = 100
+# seconds that the blocking requests of a ChannelThread wait for the device and then for the reply
+COMMAND_TIMEOUT = 5.
+
+
+class CommandChannel:
+    """ asyncio channel for commands and status requests to an acquired mod-t device (see ChannelThread).
+
+    one reader task per read endpoint drains the replies. command replies are matched to their request by the id in
+    transport.id, status replies are handed to the status requests in order. several commands can thus be in flight
+    at once, and status requests never wait for command replies. the blocking usb calls run in the default executor """
+
+    def __init__(self, modt, device):
+        self.modt = modt
+        self.device = device
+        # running id -> future of the reply, in the order the commands were sent
+        self._pending = collections.OrderedDict()
+        self._status_waiters = collections.deque()
+        self._command_lock = self._status_lock = None
+        self._readers = []
+        self._closed = False
+
+    async def __aenter__(self):
+        self._command_lock, self._status_lock = asyncio.Lock(), asyncio.Lock()
+        self._readers = [asyncio.ensure_future(self._read_loop(Endpoints.COMMAND_READ, self._dispatch_reply)),
+                         asyncio.ensure_future(self._read_loop(Endpoints.BASIC_READ, self._dispatch_status))]
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """ stops the readers and returns the error that stopped one of them early, if any """
+        self._closed = True
+        results = await asyncio.gather(*self._readers, return_exceptions=True)
+        for future in [*self._pending.values(), *self._status_waiters]:
+            future.cancel()
+        self._pending.clear()
+        self._status_waiters.clear()
+        return next((result for result in results if isinstance(result, Exception)), None)
+
+    async def _read_loop(self, endpoint, dispatch):
+        """ reads the messages of endpoint like ModT._read_response, one transfer at a time. a message may time out
+        between its transfers, so the part read so far is kept until the framing says that it is complete """
+        loop = asyncio.get_running_loop()
+        chunk = array.array("B", bytes(RESPONSE_READ_SIZE))
+        message = bytearray()
+        while not self._closed:
+            try:
+                n_read = await loop.run_in_executor(None, self.device.read, endpoint, chunk, READ_TIMEOUT)
+            except usb.core.USBTimeoutError:
+                continue
+            except Exception as e:
+                # the channel is unusable without its reader. fail everyone waiting instead of letting them time out
+                self._closed = True
+                waiters = self._pending.values() if endpoint == Endpoints.COMMAND_READ else self._status_waiters
+                for future in waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            message += memoryview(chunk)[:n_read]
+            if message and (n_read < len(chunk) or response_complete(message)):
+                if logging.getLogger().isEnabledFor(logging.DEBUG):
+                    logging.debug("read data from device: %r", bytes(message))
+                dispatch(bytes(message))
+                message = bytearray()
+        if message:
+            logging.debug("dropping incomplete message %r", bytes(message))
+
+    def _dispatch_reply(self, reply):
+        transport_id = reply_id(reply)
+        future = None
+        if transport_id is not None:
+            future = self._pending.pop(transport_id, None)
+        elif self._pending:
+            # a reply without an id answers the oldest command, just like a blocking read would. replies with unknown
+            # ids are dropped, e.g. the ones to commands whose request timed out
+            _, future = self._pending.popitem(last=False)
+        if future is None:
+            logging.debug("dropping unexpected reply %r", reply)
+        elif not future.done():
+            future.set_result(reply[5:].decode("latin-1"))
+
+    def _dispatch_status(self, message):
+        while self._status_waiters:
+            future = self._status_waiters.popleft()
+            if not future.done():
+                future.set_result(message)
+                return
+        logging.debug("dropping unrequested status %r", message)
+
+    async def command(self, command_name, arguments=None, timeout=5.):
+        """ sends a command and returns its reply without the header, like ModT._exec_command """
+        if self._closed:
+            raise PrinterError("command channel is closed")
+        loop = asyncio.get_running_loop()
+        async with self._command_lock:
+            request_id = type(self.modt).running_id
+            future = self._pending[request_id] = loop.create_future()
+            try:
+                await loop.run_in_executor(None, self.modt._send_command, self.device, command_name, arguments)
+            except BaseException:
+                self._pending.pop(request_id, None)
+                raise
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def status(self, as_dict=True, timeout=5.):
+        """ requests and returns the status of the printer, like ModT.get_status """
+        if self._closed:
+            raise PrinterError("command channel is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        async with self._status_lock:
+            self._status_waiters.append(future)
+            await loop.run_in_executor(None, self.device.write, Endpoints.BASIC_WRITE, STATUS_REQUEST)
+        try:
+            message = await asyncio.wait_for(future, timeout)
+        finally:
+            if future in self._status_waiters:
+                self._status_waiters.remove(future)
+        return self.modt._decode_status(message, as_dict=as_dict)
+
+
+class ChannelThread:
+    """ the CommandChannel behind the blocking commands and status requests of a ModT. the channel runs on an event
+    loop in a daemon thread and holds the device while requests are in flight, so that the requests of several
+    threads (e.g. status polls and web requests) are sent concurrently and matched to their replies by id. once no
+    request is left, the device is released for exclusive users (see paused) and other processes """
+
+    def __init__(self, modt):
+        self.modt = modt
+        self.thread = None
+        self._loop = None
+        self._start_lock = threading.Lock()
+        # the state of the channel, only used in the thread of the loop
+        self._channel = None
+        self._device = None
+        self._active = self._paused = 0
+        self._changed = None
+
+    def _start(self):
+        with self._start_lock:
+            if self.thread is None:
+                self._loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._loop.run_forever, name="command-channel", daemon=True)
+                self.thread.start()
+        return self._loop
+
+    def _run(self, coroutine_function, *args):
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("the command channel can't wait for itself")
+        return asyncio.run_coroutine_threadsafe(coroutine_function(*args), self._start()).result()
+
+    def command(self, command_name, arguments=None, timeout=COMMAND_TIMEOUT):
+        """ sends a command and returns its reply without the header """
+        return self._run(self._request, lambda channel, remaining: channel.command(command_name, arguments,
+                                                                                   timeout=remaining), timeout)
+
+    def status(self, as_dict=True, timeout=COMMAND_TIMEOUT):
+        """ requests and returns the status of the printer """
+        return self._run(self._request, lambda channel, remaining: channel.status(as_dict=as_dict,
+                                                                                  timeout=remaining), timeout)
+
+    @contextlib.contextmanager
+    def paused(self):
+        """ closes the channel and keeps it closed, e.g. while an upload or reset uses the device directly. waits for
+        the requests in flight, the ones made meanwhile wait until the channel is resumed or they time out """
+        self._run(self._pause)
+        try:
+            yield
+        finally:
+            self._run(self._resume)
+
+    def _condition(self):
+        # created in the loop, as asyncio primitives of older pythons bind to the loop they are created in
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    async def _request(self, request, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        changed = self._condition()
+        async with changed:
+            try:
+                await asyncio.wait_for(changed.wait_for(lambda: not self._paused), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("the printer is busy, e.g. with an upload") from None
+            if self._channel is None:
+                # not subject to the timeout, so that a device that is being acquired is always released again. the
+                # lock timeout of the device bounds it
+                await self._open()
+            self._active += 1
+        try:
+            return await request(self._channel, max(0., deadline - loop.time()))
+        except asyncio.TimeoutError:
+            raise TimeoutError("the printer didn't answer within %s s" % timeout) from None
+        finally:
+            async with changed:
+                self._active -= 1
+                if not self._active:
+                    await self._close()
+                    changed.notify_all()
+
+    async def _open(self):
+        loop = asyncio.get_running_loop()
+        device = self.modt.get_device()
+        dev = await loop.run_in_executor(None, device.__enter__)
+        self._device = device
+        self._channel = await CommandChannel(self.modt, dev).__aenter__()
+
+    async def _close(self):
+        channel, device = self._channel, self._device
+        self._channel = self._device = None
+        error = await channel.close()
+        # a usb error of a reader reaches get_device, which reconnects on next use
+        exc_info = (type(error), error, error.__traceback__) if error is not None else (None, None, None)
+        await asyncio.get_running_loop().run_in_executor(None, device.__exit__, *exc_info)
+
+    async def _pause(self):
+        changed = self._condition()
+        async with changed:
+            self._paused += 1
+            # the last request in flight closes the channel
+            await changed.wait_for(lambda: self._channel is None)
+
+    async def _resume(self):
+        changed = self._condition()
+        async with changed:
+            self._paused -= 1
+            changed.notify_all()
@@ -0,0 +1,94 @@
+import functools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+
+
+class StatusSnapshot(NamedTuple):
+    """ status of the printer at time (time.time()). snapshots are replaced as a whole and never modified, so that
+    readers can use them without a lock. the status dict must be treated as read-only """
+    status: dict
+    time: float
+
+    @property
+    def age(self):
+        return time.time() - self.time
+
+
+class DeviceOwner:
+    """ thread that holds the usb device of a printer on behalf of all other threads. it polls the status every
+    poll_interval seconds with poll() and runs the submitted commands in between, one at a time and in order.
+    commands that use the device for a long time, e.g. uploads and resets, thus queue for it instead of failing to
+    get its lock, and status readers use the snapshots published by poll without touching the device at all """
+
+    def __init__(self, poll, poll_interval=.5):
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self._tasks = queue.Queue()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_owner(self):
+        return threading.current_thread() is self.thread
+
+    def start(self):
+        if not self.running:
+            self.thread = threading.Thread(target=self._run, name="device-owner", daemon=True)
+            self.thread.start()
+        return self.thread
+
+    def submit(self, function, *args, **kwargs) -> Future:
+        """ runs function in the owner thread without waiting for it. if the owner isn't running or this is the owner
+        thread, which is busy with the caller, function runs in a thread of its own instead """
+        future = Future()
+        if not self.running or self.is_owner():
+            threading.Thread(target=self._execute, args=(future, function, args, kwargs), daemon=True).start()
+        else:
+            self._tasks.put((future, function, args, kwargs))
+        return future
+
+    def run(self, function, *args, **kwargs):
+        """ runs function in the owner thread and returns its result. runs it directly if the owner isn't running or
+        this is the owner thread, e.g. for commands issued by other commands """
+        if not self.running or self.is_owner():
+            return function(*args, **kwargs)
+        return self.submit(function, *args, **kwargs).result()
+
+    def _run(self):
+        next_poll = 0
+        while True:
+            try:
+                future, function, args, kwargs = self._tasks.get(timeout=max(0, next_poll - time.monotonic()))
+            except queue.Empty:
+                try:
+                    self.poll()
+                except Exception as e:
+                    logging.debug("couldn't get status: %s" % e)
+                next_poll = time.monotonic() + self.poll_interval
+                continue
+            self._execute(future, function, args, kwargs)
+
+    @staticmethod
+    def _execute(future, function, args, kwargs):
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def device_command(method):
+    """ decorator for methods that change the state of the printer. they run in the DeviceOwner of the instance
+    (self.owner) if it is running """
+
+    @functools.wraps(method)
+    def __wrapper__(self, *args, **kwargs):
+        return self.owner.run(method, self, *args, **kwargs)
+
+    return __wrapper__
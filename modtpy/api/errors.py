@@ -7,6 +7,10 @@ class PrinterError(Exception):
         self.payload = payload
         self.__repr__ = self.__str__
 
+    def __reduce__(self):
+        # the message isn't in self.args, which pickle would pass to __init__ by default
+        return self.__class__, (self.message, self.status_code, self.payload)
+
     def to_dict(self):
         rv = dict(self.payload or ())
         rv['message'] = self.message
@@ -14,3 +18,9 @@ class PrinterError(Exception):
 
     def __str__(self):
         return "PrinterError(message=%s, payload='%s')" % (self.message, self.payload)
+
+
+class UploadCancelled(PrinterError):
+
+    def __init__(self, message="upload cancelled", status_code=None, payload=None):
+        PrinterError.__init__(self, message, status_code=status_code, payload=payload)
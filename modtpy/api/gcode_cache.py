@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from zlib import adler32
+
+from modtpy.api.gcode_optimization import GcodeOptimizer, OPTIMIZER_VERSION, write_lines
+from modtpy.api.utils import gcode_buffer
+
+CACHE_DIR = os.sep.join([os.path.expanduser("~"), ".modtpy", "gcode_cache"])
+
+
+class CacheEntry:
+    def __init__(self, path, size, adler32):
+        self.path = path
+        self.size = size
+        # checksum as expected by the mod-t (see modt.adler32_checksum), so that sending can skip computing it
+        self.adler32 = adler32
+
+    def __repr__(self):
+        return "CacheEntry(path=%s, size=%i, adler32=%i)" % (self.path, self.size, self.adler32)
+
+
+class _ChecksumWriter:
+    """ encodes written text to the binary file f while keeping track of its size and mod-t adler32 checksum """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.adler32 = 0  # the mod-t uses 0, not 1 as the basis of the adler32 sum
+
+    def write(self, text):
+        data = text.encode()
+        self.f.write(data)
+        self.size += len(data)
+        self.adler32 = adler32(data, self.adler32)
+
+
+class GcodeCache:
+    """ disk-backed cache of optimized gcode, keyed by the content hash of the original gcode and the optimizer
+    settings. each entry is stored as <key>.gcode together with <key>.json holding its size and adler32 checksum.
+    the least recently used entries are evicted once the cache grows beyond max_size bytes """
+
+    def __init__(self, directory=CACHE_DIR, max_size=1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content_hash, error_threshold, optimizer: GcodeOptimizer, welder=None):
+        parts = [content_hash, repr(float(error_threshold)), "v%s" % OPTIMIZER_VERSION, optimizer.algorithm]
+        if welder is not None:
+            parts.append("arcs:%r" % (welder.settings,))
+        return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.directory, key)
+        return base + ".gcode", base + ".json"
+
+    def get(self, key):
+        gcode_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            # mark as recently used
+            os.utime(gcode_path)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(gcode_path, meta["size"], meta["adler32"])
+
+    def put(self, key, lines):
+        """ writes lines to the cache entry for key, computing size and checksum on the fly """
+        gcode_path, meta_path = self._paths(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = _ChecksumWriter(f)
+                write_lines(lines, writer)
+            os.replace(tmp_path, gcode_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with open(meta_path, "w") as f:
+            json.dump(dict(size=writer.size, adler32=writer.adler32, created=time.time()), f)
+        # the new entry is kept even if it exceeds max_size by itself, as it is about to be used
+        self.evict(keep=gcode_path)
+        return CacheEntry(gcode_path, writer.size, writer.adler32)
+
+    def evict(self, keep=None):
+        """ removes the least recently used entries until the cache fits max_size, except for the entry at the path
+        keep """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".gcode"):
+                path = os.path.join(self.directory, name)
+                if path == keep:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            for p in (path, path[:-len(".gcode")] + ".json"):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+
+    def optimize(self, gcode_file, optimizer: GcodeOptimizer, error_threshold=0.15, welder=None, logger=None,
+                 wrap_lines=None):
+        """ returns the cache entry holding the optimized version of gcode_file, which is either a path or a binary
+        file object read from its current position. the gcode is only optimized if it isn't cached yet. the input is
+        hashed and optimized straight from a memory map (see utils.gcode_buffer) instead of being read into memory.
+        wrap_lines wraps the optimized lines as they are written, e.g. PrintJob.watch to abort the optimization """
+        if logger is None:
+            logger = logging.getLogger()
+
+        with gcode_buffer(gcode_file) as buffer:
+            key = self.key(hashlib.sha256(buffer).hexdigest(), error_threshold, optimizer, welder)
+            entry = self.get(key)
+            if entry is not None:
+                logger.info("using cached optimized gcode %s", entry.path)
+                return entry
+
+            lines = optimizer.optimize_buffer(buffer, error_threshold=error_threshold, logger=logger)
+            if welder is not None:
+                lines = welder.weld_lines(lines, logger=logger)
+            if wrap_lines is not None:
+                lines = wrap_lines(lines)
+            return self.put(key, lines)
+
+    def optimize_to(self, gcode_path, output_path, optimizer: GcodeOptimizer, error_threshold=0.15, welder=None,
+                    logger=None):
+        """ like optimize, but copies the optimized gcode to output_path """
+        entry = self.optimize(gcode_path, optimizer, error_threshold=error_threshold, welder=welder, logger=logger)
+        shutil.copyfile(entry.path, output_path)
+        return entry
@@ -1,52 +1,53 @@
-import copy
 import logging
 import math
+import operator
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+
 import tqdm
 
+from modtpy.api.gcode_tokenizer import Instruction, tokenize_line, iter_text_lines, FLAG_X, FLAG_Y, FLAG_Z, FLAG_E, FLAG_F
 from modtpy.api.utils import TqdmLogger
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
-class Vec3:
-    def __init__(self, x, y, z):
-        self.x, self.y, self.z = x, y, z
+class Vec3(NamedTuple):
+    """ immutable 3d vector. as a tuple subclass without instance __dict__, it is cheap to create and never needs
+    to be copied """
+    x: float
+    y: float
+    z: float
 
     def __pow__(self, power):
-        return Vec3(self.x ** 2, self.y ** 2, self.z ** 2)
+        return Vec3(self.x ** power, self.y ** power, self.z ** power)
 
     def _math_op(self, other, op_fun):
-        if isinstance(other, Vec3):
-            return Vec3(op_fun(self.x, other.x), op_fun(self.y, other.y), op_fun(self.z, other.z))
-        elif isinstance(other, (int, float)):
-            return Vec3(op_fun(self.x, other), op_fun(self.y, other), op_fun(self.z, other))
-        elif isinstance(other, (list, tuple)):
+        if isinstance(other, tuple):
             assert len(other) == 3
             return Vec3(op_fun(self.x, other[0]), op_fun(self.y, other[1]), op_fun(self.z, other[2]))
+        elif isinstance(other, (int, float)):
+            return Vec3(op_fun(self.x, other), op_fun(self.y, other), op_fun(self.z, other))
         else:
-            raise RuntimeError("encountered invalid type for mul: %s" % type(other))
-
-    def __eq__(self, other):
-        return self.x == other.x and self.y == other.y and self.z == other.z
+            raise RuntimeError("encountered invalid type for math operation: %s" % type(other))
 
     def __mul__(self, other):
-        return self._math_op(other, lambda x, y: x * y)
+        return self._math_op(other, operator.mul)
+
+    __rmul__ = __mul__
 
     def __sub__(self, other):
-        return self._math_op(other, lambda x, y: x - y)
+        return self._math_op(other, operator.sub)
 
     def __add__(self, other):
-        return self._math_op(other, lambda x, y: x + y)
+        return self._math_op(other, operator.add)
 
     def copy(self):
-        return Vec3(self.x, self.y, self.z)
-
-    def __len__(self):
-        return 3
-
-    def __getitem__(self, item):
-        return [self.x, self.y, self.z][item]
-
-    def __setitem__(self, key, value):
-        self.__setattr__("x y z".split()[key], value)
+        return self
 
     def cross(self, other):
         return Vec3(self.y * other.z - self.z * other.y,
@@ -57,7 +58,7 @@ class Vec3:
         return math.sqrt(self.x ** 2 + self.y ** 2 + self.z ** 2)
 
     def __str__(self):
-        return "Vec3(%.4f, %.4f, %.4f)"
+        return "Vec3(%.4f, %.4f, %.4f)" % self
 
 
 def sign(x):
@@ -68,23 +69,155 @@ def mag(a):
     return math.sqrt(a[0] ** 2 + a[1] ** 2 + a[2] ** 2)
 
 
-indices = {'G': 0, 'F': 1, 'X': 2, 'Y': 3, 'Z': 4, 'E': 5}
+def is_move(instruction: Instruction):
+    return instruction.command == "G0" or instruction.command == "G1"
+
+
+def split_at_sequence_boundaries(lines, chunk_lines):
+    """ splits gcode lines into chunks of roughly chunk_lines lines that can be optimized independently.
+
+    every chunk starts at a line that is not a G0/G1 move (e.g. a layer change comment or a G92), where the optimizer
+    always closes the open sequence. yields (state, chunk) tuples, where state holds the optimizer state at the start
+    of the chunk (see GcodeOptimizer.set_state), which is tracked by following the position through all moves """
+    x = y = z = e = 0
+    feedrate, moved = None, False
+    state, chunk = ((x, y, z), e, -1, feedrate), []
+    for line in lines:
+        line = line.rstrip("\n")
+        instruction = tokenize_line(line)
+        if instruction.command is None and not line.strip():
+            continue
+        flags = instruction.flags
+        if is_move(instruction):
+            if flags & FLAG_F:
+                feedrate = instruction.f
+            moved = True
+        elif len(chunk) >= chunk_lines:
+            yield state, chunk
+            state, chunk = ((x, y, z), e, feedrate if moved else -1, feedrate), []
+        if is_move(instruction) or instruction.command == "G92":
+            if flags & FLAG_X:
+                x = instruction.x
+            if flags & FLAG_Y:
+                y = instruction.y
+            if flags & FLAG_Z:
+                z = instruction.z
+            if flags & FLAG_E:
+                e = instruction.e
+        chunk.append(line)
+    if chunk:
+        yield state, chunk
+
+
+def _optimize_chunk(options, state, chunk, error_threshold):
+    # runs in a worker process of GcodeOptimizer._optimize_parallel
+    optimizer = GcodeOptimizer(**options)
+    optimizer.set_state(*state)
+    return list(optimizer._optimize(chunk, error_threshold))
+
+
+class Corridor:
+    """ the cone of directions from a start point in which a line passes within max_error of every point added so far.
+
+    adding a point and testing a direction are O(1), which makes the corridor algorithm linear in the number of moves.
+    points closer than max_error to the start impose no constraint, every other point restricts the cone to the
+    directions within asin(max_error / distance) of it. the cone only covers the XY plane, since sequences never
+    change Z. sequences that do (e.g. a move right after a Z hop) are reported as not mergeable """
+
+    def __init__(self, start: Vec3, max_error):
+        self.x, self.y, self.z = start.x, start.y, start.z
+        self.max_error = max_error
+        self.max_distance = 0.
+        self.planar = True
+        # angle of the first constraining point, lower and upper bounds of the cone are stored relative to it
+        self.reference = self.lower = self.upper = None
+
+    def _relative_angle(self, dx, dy):
+        angle = math.atan2(dy, dx) - self.reference
+        if angle > math.pi:
+            angle -= 2 * math.pi
+        elif angle < -math.pi:
+            angle += 2 * math.pi
+        return angle
+
+    def add(self, point: Vec3):
+        if point.z != self.z:
+            self.planar = False
+            return
+        dx, dy = point.x - self.x, point.y - self.y
+        distance = math.hypot(dx, dy)
+        self.max_distance = max(self.max_distance, distance)
+        if distance <= self.max_error:
+            return
+        half_width = math.asin(self.max_error / distance)
+        if self.reference is None:
+            self.reference = math.atan2(dy, dx)
+            self.lower, self.upper = -half_width, half_width
+        else:
+            angle = self._relative_angle(dx, dy)
+            self.lower = max(self.lower, angle - half_width)
+            self.upper = min(self.upper, angle + half_width)
+
+    def allows(self, end: Vec3):
+        """ whether all points added so far are within max_error of the line from the start point to end """
+        if not self.planar or end.z != self.z:
+            return False
+        dx, dy = end.x - self.x, end.y - self.y
+        if dx == 0 and dy == 0:  # start and finish in same place
+            return self.max_distance <= self.max_error
+        if self.reference is None:
+            return True
+        return self.lower <= self._relative_angle(dx, dy) <= self.upper
+
+# bump whenever a change of the optimizer changes its output, to invalidate cached results (see gcode_cache)
+OPTIMIZER_VERSION = 1
+
+# backends for computing the error of merging a sequence of moves. both produce identical results,
+# the numpy backend evaluates all points of a sequence at once, which pays off for long sequences
+BACKENDS = ("python", "numpy")
+
+# algorithms for deciding whether a move can be merged into the current sequence.
+# exact: re-checks the distance of every point of the sequence to the new line, quadratic in the sequence length.
+# corridor: keeps a cone of admissible directions (see Corridor), linear in the sequence length. it never exceeds
+#   error_threshold either, but is more conservative than exact and therefore merges slightly fewer moves
+ALGORITHMS = ("exact", "corridor")
 
 
 class GcodeOptimizer:
-    def __init__(self):
+    def __init__(self, backend="python", algorithm="exact", jobs=1, chunk_lines=20000):
+        if backend not in BACKENDS:
+            raise ValueError("unknown backend %s, must be one of %s" % (backend, ", ".join(BACKENDS)))
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unknown algorithm %s, must be one of %s" % (algorithm, ", ".join(ALGORITHMS)))
+        if backend == "numpy" and np is None:
+            raise RuntimeError("the numpy backend requires numpy, install it with: pip install numpy")
+        self.backend = backend
+        self.algorithm = algorithm
+        # with jobs > 1, the input is split into chunks of about chunk_lines lines which are optimized by a process pool
+        self.jobs = jobs
+        self.chunk_lines = chunk_lines
+        self.error_threshold = 0.15
+        # numpy backend: preallocated buffer holding the points of sequenceXYZ, grown on demand
+        self._sequence_points = np.empty((256, 3)) if backend == "numpy" and algorithm == "exact" else None
+        self._corridor = None
         self.nextXYZ = self.sequenceFeedrate = self.sequenceXYZ = self.sequenceExtruding = self.sequenceE = None
         self.curXYZ = Vec3(0, 0, 0)
         self.curE = self.nextE = 0
         self.newSequence = True
         self.lastF = -1
 
+    def set_state(self, xyz, e, last_f, feedrate):
+        """ continue optimizing from the given position, extruder position, last written and last commanded feedrate """
+        self.curXYZ = Vec3(*xyz)
+        self.curE = e
+        self.lastF = last_f
+        self.sequenceFeedrate = feedrate
+        self.newSequence = True
+
     def finish_sequence(self, XYZ, E, F):
         """ we're here because the sequence is ready to be "closed out"
          this may have happened because of a change in feed-rate, extruder behavior, a non-G1 code,
         or that the error may have been too great. regardless, it's time to finish write one line of g-code """
-        result = []
-
         outline = 'G1'
 
         if self.lastF != F:
@@ -99,34 +232,31 @@ class GcodeOptimizer:
         if E != self.curE:
             outline = outline + ' E' + str(E)
 
-        result.append(outline)
-
-        self.curXYZ = XYZ.copy()
-        self.curE = copy.deepcopy(E)
-        return result
+        self.curXYZ = XYZ
+        self.curE = E
+        return outline
 
-    def init_sequence(self, flags, args, curXYZ: Vec3, curE):
+    def init_sequence(self, move: Instruction, curXYZ: Vec3, curE):
 
         # initialize a new sequence
         # define sequence feedrate, if it is set
-        if flags[1]:
-            self.sequenceFeedrate = args[1]
+        flags = move.flags
+        if flags & FLAG_F:
+            self.sequenceFeedrate = move.f
 
         # add this G-code's target to the position sequence
-        self.nextXYZ = copy.deepcopy(curXYZ)
-        self.nextE = copy.deepcopy(curE)
-
-        if flags[2]:
-            self.nextXYZ.x = args[2]
-        if flags[3]:
-            self.nextXYZ.y = args[3]
-        if flags[4]:
-            self.nextXYZ[2] = args[4]
-        if flags[5]:
-            self.nextE = args[5]
-
-        self.sequenceXYZ = [copy.copy(self.nextXYZ)]
-        self.sequenceE = [copy.copy(self.nextE)]
+        self.nextXYZ = Vec3(move.x if flags & FLAG_X else curXYZ.x,
+                            move.y if flags & FLAG_Y else curXYZ.y,
+                            move.z if flags & FLAG_Z else curXYZ.z)
+        self.nextE = move.e if flags & FLAG_E else curE
+
+        self.sequenceXYZ = [self.nextXYZ]
+        self.sequenceE = [self.nextE]
+        if self._sequence_points is not None:
+            self._sequence_points[0] = self.nextXYZ
+        if self.algorithm == "corridor":
+            self._corridor = Corridor(curXYZ, self.error_threshold)
+            self._corridor.add(self.nextXYZ)
 
         # check if this sequence is moving the extruder forward, backward, or not
         if self.nextE > self.curE:
@@ -139,139 +269,390 @@ class GcodeOptimizer:
         # set the new sequence flag to false now, since we just primed a new sequence
         self.newSequence = False
 
-    def optimize_gcode(self, gcode, error_threshold=0.15, logger=None):
-        result = []
-
+    def append_to_sequence(self, xyz: Vec3, e):
+        self.sequenceXYZ.append(xyz)
+        self.sequenceE.append(e)
+        if self._sequence_points is not None:
+            n = len(self.sequenceXYZ)
+            if n > len(self._sequence_points):
+                self._sequence_points = np.concatenate([self._sequence_points, np.empty_like(self._sequence_points)])
+            self._sequence_points[n - 1] = xyz
+        if self._corridor is not None:
+            self._corridor.add(xyz)
+
+    def sequence_error_exceeds(self, pos_1: Vec3, pos_2: Vec3, error_threshold):
+        """ whether any point of the current sequence is further than error_threshold away from the line pos_1-pos_2 """
+        if self._corridor is not None:
+            return not self._corridor.allows(pos_2)
+        if self._sequence_points is not None:
+            return self._sequence_error_exceeds_numpy(pos_1, pos_2, error_threshold)
+
+        # calculate the orthogonal distances between all intermediate points and the
+        # "shortcut" line. see http://mathworld.wolfram.com/Point-LineDistance3-Dimensional.html
+        # this is the hot loop of the optimizer, so the vector math of Vec3 is inlined on plain floats
+        x1, y1, z1 = pos_1
+        if pos_1 == pos_2:  # start and finish in same place
+            for x, y, z in self.sequenceXYZ:
+                if math.sqrt((x - x1) ** 2 + (y - y1) ** 2 + (z - z1) ** 2) > error_threshold:
+                    return True
+            return False
+
+        x2, y2, z2 = pos_2
+        sequence_length = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2 + (z2 - z1) ** 2)
+        for x, y, z in self.sequenceXYZ:
+            ex1, ey1, ez1 = x - x1, y - y1, z - z1
+            ex2, ey2, ez2 = x - x2, y - y2, z - z2
+            cross_x = ey1 * ez2 - ez1 * ey2
+            cross_y = ez1 * ex2 - ex1 * ez2
+            cross_z = ex1 * ey2 - ey1 * ex2
+            if math.sqrt(cross_x ** 2 + cross_y ** 2 + cross_z ** 2) / sequence_length > error_threshold:
+                return True
+        return False
+
+    def _sequence_error_exceeds_numpy(self, pos_1: Vec3, pos_2: Vec3, error_threshold):
+        # same arithmetic as the python backend, applied to all points at once, so that results are bit-identical
+        points = self._sequence_points[:len(self.sequenceXYZ)]
+        err_1 = points - pos_1
+        x1, y1, z1 = err_1[:, 0], err_1[:, 1], err_1[:, 2]
+        if pos_1 == pos_2:  # start and finish in same place
+            errors = np.sqrt(x1 * x1 + y1 * y1 + z1 * z1)
+        else:
+            sequence_length = (pos_2 - pos_1).mag()
+            err_2 = points - pos_2
+            x2, y2, z2 = err_2[:, 0], err_2[:, 1], err_2[:, 2]
+            cross_x = y1 * z2 - z1 * y2
+            cross_y = z1 * x2 - x1 * z2
+            cross_z = x1 * y2 - y1 * x2
+            errors = np.sqrt(cross_x * cross_x + cross_y * cross_y + cross_z * cross_z) / sequence_length
+        return bool((errors > error_threshold).any())
+
+    def optimize_lines(self, lines, error_threshold=0.15, logger=None):
+        """ optimize an iterable of gcode lines (e.g. an open text file) and return an iterator over the optimized lines.
+        only the currently open movement sequence (or with jobs > 1, a bounded number of chunks) is kept in memory,
+        so memory usage does not grow with the input """
         if logger is None:
             logger = logging.getLogger()
 
         tqdm_out = TqdmLogger(logger)
-
-        for this_line in tqdm.tqdm(gcode.split("\n"), file=tqdm_out, desc="Optimizing gcode"):
+        lines = tqdm.tqdm(lines, file=tqdm_out, desc="Optimizing gcode", unit=" lines")
+
+        if self.jobs > 1:
+            return self._optimize_parallel(lines, error_threshold)
+        return self._optimize(lines, error_threshold)
+
+    def _optimize_parallel(self, lines, error_threshold):
+        options = dict(backend=self.backend, algorithm=self.algorithm)
+        with ProcessPoolExecutor(self.jobs) as pool:
+            pending = deque()
+            for state, chunk in split_at_sequence_boundaries(lines, self.chunk_lines):
+                pending.append(pool.submit(_optimize_chunk, options, state, chunk, error_threshold))
+                # limit the number of chunks in flight so that memory usage stays bounded
+                if len(pending) >= 2 * self.jobs:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+    def _optimize(self, lines, error_threshold):
+        self.error_threshold = error_threshold
+
+        for this_line in lines:
+            this_line = this_line.rstrip("\n")
+            instruction = tokenize_line(this_line)
             # ignore empty lines
-            if not this_line.strip():
+            if instruction.command is None and not this_line.strip():
                 continue
 
             # if anything other than a G0 or G1 command, copy it after g-codes from an unfinished sequence
             # also flag that a new movement sequence needs to be started
-            if not ((this_line[0:3] == 'G0 ') or (this_line[0:3] == 'G1 ')):
+            if not is_move(instruction):
                 if not self.newSequence:
-                    result += self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
+                    yield self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
 
                 self.newSequence = True
-                result.append(this_line)
+                yield this_line
 
                 # check for G92 line, and reset current axis positions accordingly.
                 # Writing out the g-code first, if necessary
-                if this_line.startswith('G92'):
-                    codes = this_line.rstrip().split(' ')
-                    flags = [False, False, False, False, False, False]  # GFXYZE commanded flags
-                    args = [0, 0, 0, 0, 0, 0]  # GFXYZE arguments
-                    for code in codes:
-                        key = code[0]
-                        idx = indices.get(key)
-                        if idx == 2:
-                            self.curXYZ.x = float(code[1:])
-                        elif idx == 3:
-                            self.curXYZ.y = float(code[1:])
-                        elif idx == 4:
-                            self.curXYZ.z = float(code[1:])
-                        elif idx == 5:
-                            self.curE = float(code[1:])
+                if instruction.command == "G92":
+                    flags = instruction.flags
+                    self.curXYZ = Vec3(instruction.x if flags & FLAG_X else self.curXYZ.x,
+                                       instruction.y if flags & FLAG_Y else self.curXYZ.y,
+                                       instruction.z if flags & FLAG_Z else self.curXYZ.z)
+                    if flags & FLAG_E:
+                        self.curE = instruction.e
                 continue
 
-            # Okay, we're here for a G0 or G1 (move command). Parse it.
-            # first remove trailing comments as well as leading and trailing whitespace and split into words
-            codes = this_line.split(';')[0].strip().split(' ')
-
-            flags = [False, False, False, False, False, False]  # GFXYZE commanded flags
-            args = [0, 0, 0, 0, 0, 0]  # GFXYZE arguments
-            for code in codes:
-                key = code[0]
-                idx = indices.get(key, 'default')
-                flags[idx] = True
-                args[idx] = float(code[1:])
+            # Okay, we're here for a G0 or G1 (move command).
+            flags = instruction.flags
 
             # check if it's the first move in a sequence
             if self.newSequence:
                 # don't worry about checking anything, just continue with next g-code line
                 # after prepping variables for next loop
-                self.init_sequence(flags, args, self.curXYZ, self.curE)
+                self.init_sequence(instruction, self.curXYZ, self.curE)
 
             else:
                 # check feedrate versus previous move
-                if flags[1]:
-                    if args[1] != self.sequenceFeedrate:
+                if flags & FLAG_F:
+                    if instruction.f != self.sequenceFeedrate:
                         # the commanded feedrate is different than the sequence feedrate,
                         # so we need to write out the G-code and start a new sequence with this move
-                        result += self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
-                        self.init_sequence(flags, args, self.curXYZ, self.curE)
+                        yield self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
+                        self.init_sequence(instruction, self.curXYZ, self.curE)
                         continue
 
                 # check extruder activity versus previous move.
                 # note that I'm only checking consistency of direction of extruder motion (+/-/0)
                 # theoretically, an increase or decrease in speed will mess this up, but I don't
                 # expect incoming G code to do that. Something to fix later perhaps.
-                if flags[5]:  # an E position is commanded
-                    eDir = sign(args[5] - self.sequenceE[-1])
+                if flags & FLAG_E:  # an E position is commanded
+                    eDir = sign(instruction.e - self.sequenceE[-1])
                 else:
                     eDir = 0
 
                 if eDir != self.sequenceExtruding:
                     # the extruder is starting, stopping, or changing direction, so we need
                     # to start a new sequence
-                    result += self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
-                    self.init_sequence(flags, args, self.curXYZ, self.curE)
+                    yield self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
+                    self.init_sequence(instruction, self.curXYZ, self.curE)
                     continue
 
                 # we've made it this far, so the feedrate and extruder behavior haven't changed.
                 # so now we check the geometry of the path in XYZ - how much error would be
                 # introduced if we eliminate this segment and just link it to the previous?
-
-                # calculate the orthogonal distances between all intermediate points and the
-                # "shortcut" line. see http://mathworld.wolfram.com/Point-LineDistance3-Dimensional.html
-
-                next_xyz = copy.deepcopy(self.sequenceXYZ[-1])
-
-                if flags[2]:
-                    next_xyz.x = args[2]
-                if flags[3]:
-                    next_xyz.y = args[3]
-                if flags[4]:
-                    next_xyz.z = args[4]
-                if flags[5]:
-                    self.nextE = args[5]
-
-                pos_1 = copy.deepcopy(self.curXYZ)
-                pos_2 = copy.deepcopy(next_xyz)
-                errors = []
-                if pos_1 == pos_2:  # start and finish in same place
-                    for pos_i in self.sequenceXYZ:
-                        errors.append((pos_i - pos_1).mag())
-                else:
-                    sequence_length = (pos_2 - pos_1).mag()
-
-                    for pos_i in self.sequenceXYZ:
-                        err_1 = pos_i - pos_1
-                        err_2 = pos_i - pos_2
-                        errors.append(err_1.cross(err_2).mag() / sequence_length)
-
-                error_large = any(e > error_threshold for e in errors)
+                last_xyz = self.sequenceXYZ[-1]
+                next_xyz = Vec3(instruction.x if flags & FLAG_X else last_xyz.x,
+                                instruction.y if flags & FLAG_Y else last_xyz.y,
+                                instruction.z if flags & FLAG_Z else last_xyz.z)
+                if flags & FLAG_E:
+                    self.nextE = instruction.e
 
                 # make a new segment regardless of error if z-axis position change
-                if error_large or (next_xyz.z != self.curXYZ.z):
+                if next_xyz.z != self.curXYZ.z or self.sequence_error_exceeds(self.curXYZ, next_xyz, error_threshold):
                     # the error is too great, so we need to close out the previous sequence and start a new one
-                    result += self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1],
-                                                   self.sequenceFeedrate)
-                    self.init_sequence(flags, args, self.curXYZ, self.curE)
+                    yield self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1],
+                                               self.sequenceFeedrate)
+                    self.init_sequence(instruction, self.curXYZ, self.curE)
                 else:
                     # the errors are all below the threshold, so continue the sequence
-                    self.sequenceXYZ.append(next_xyz.copy())
-                    self.sequenceE.append(copy.deepcopy(self.nextE))
+                    self.append_to_sequence(next_xyz, self.nextE)
 
         # we're at the end of the file, so write out the final open sequence (if there is one)
         if not self.newSequence:
-            result += self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
+            yield self.finish_sequence(self.sequenceXYZ[-1], self.sequenceE[-1], self.sequenceFeedrate)
+
+    def optimize_gcode(self, gcode, error_threshold=0.15, logger=None):
+        return "\n".join(self.optimize_lines(gcode.split("\n"), error_threshold=error_threshold, logger=logger))
+
+    def optimize_buffer(self, buffer, error_threshold=0.15, logger=None):
+        """ like optimize_lines for the utf-8 gcode in a bytes-like buffer, e.g. a memory-mapped file from
+        utils.gcode_buffer. lines are decoded one at a time, the buffer itself is never copied """
+        return self.optimize_lines(iter_text_lines(buffer), error_threshold=error_threshold, logger=logger)
+
+    def optimize_file(self, in_file, out_file, error_threshold=0.15, logger=None):
+        """ stream the optimized lines of the text file object in_file to the text file object out_file """
+        write_lines(self.optimize_lines(in_file, error_threshold=error_threshold, logger=logger), out_file)
+
+
+def write_lines(lines, out_file):
+    """ write lines separated by newlines to out_file, without holding more than one line in memory """
+    separator = ""
+    for line in lines:
+        out_file.write(separator)
+        out_file.write(line)
+        separator = "\n"
+
+
+def _split_words(line):
+    """ returns the command (e.g. G1) and a dict of the parameters of a gcode line """
+    words = line.split(';', 1)[0].split()
+    if not words:
+        return None, {}
+    params = {}
+    for word in words[1:]:
+        try:
+            params[word[0].upper()] = float(word[1:])
+        except ValueError:
+            pass
+    return words[0].upper(), params
+
+
+def _format_number(value, digits):
+    text = ("%.*f" % (digits, value)).rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def circle_through(a, b, c):
+    """ center of the circle through the xy coordinates of a, b and c or None if they are collinear """
+    d = 2 * (a[0] * (b[1] - c[1]) + b[0] * (c[1] - a[1]) + c[0] * (a[1] - b[1]))
+    if abs(d) < 1e-12:
+        return None
+    a2, b2, c2 = a[0] ** 2 + a[1] ** 2, b[0] ** 2 + b[1] ** 2, c[0] ** 2 + c[1] ** 2
+    return ((a2 * (b[1] - c[1]) + b2 * (c[1] - a[1]) + c2 * (a[1] - b[1])) / d,
+            (a2 * (c[0] - b[0]) + b2 * (a[0] - c[0]) + c2 * (b[0] - a[0])) / d)
+
+
+class ArcWelder:
+    """ replaces runs of G1 extrusion moves in the XY plane that lie on a circle with a single G2/G3 arc.
+
+    a run is turned into an arc if every end point is within tolerance of the circle, no chord deviates more than
+    tolerance from the arc, all segments turn in the same direction and extrude at about the same rate per mm
+    (within extrusion_tolerance), so that the extrusion of the arc is distributed as before. it can be used on its
+    own or chained after the GcodeOptimizer, e.g. ArcWelder().weld_lines(GcodeOptimizer().optimize_lines(f)).
+    bytes_in and bytes_out count the size of the processed and written gcode """
+
+    def __init__(self, tolerance=0.05, max_radius=1000., min_segments=3, max_segments=200, extrusion_tolerance=0.1):
+        self.tolerance = tolerance
+        self.max_radius = max_radius
+        self.min_segments = min_segments
+        self.max_segments = max_segments
+        self.extrusion_tolerance = extrusion_tolerance
+        self.bytes_in = self.bytes_out = self.arcs = 0
+
+    @property
+    def settings(self):
+        """ every parameter that affects the output, e.g. for cache keys """
+        return (self.tolerance, self.max_radius, self.min_segments, self.max_segments, self.extrusion_tolerance)
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def fit(self, run):
+        """ returns the center and the swept angle of the arc through all points of run, None if there is none.
+        run holds (x, y, e, line) tuples, the first one being the start point, e is the extrusion up to that point """
+        a, b, c = run[0], run[len(run) // 2], run[-1]
+        center = circle_through(a, b, c)
+        if center is None:
+            return None
+        cx, cy = center
+        radius = math.hypot(a[0] - cx, a[1] - cy)
+        if radius > self.max_radius:
+            return None
+
+        sweep = 0.
+        rates = []
+        for (x1, y1, _, _), (x2, y2, e, _) in zip(run, run[1:]):
+            if abs(math.hypot(x2 - cx, y2 - cy) - radius) > self.tolerance:
+                return None
+            chord = math.hypot(x2 - x1, y2 - y1)
+            if radius - math.sqrt(max(radius ** 2 - chord ** 2 / 4, 0.)) > self.tolerance:
+                return None
+            v1x, v1y, v2x, v2y = x1 - cx, y1 - cy, x2 - cx, y2 - cy
+            angle = math.atan2(v1x * v2y - v1y * v2x, v1x * v2x + v1y * v2y)
+            if angle * sweep < 0:  # changing direction
+                return None
+            sweep += angle
+            rates.append(e / chord)
+
+        mean_rate = sum(rates) / len(rates)
+        if abs(sweep) >= 2 * math.pi - 1e-3 or any(abs(r - mean_rate) > self.extrusion_tolerance * mean_rate
+                                                   for r in rates):
+            return None
+        return center, sweep
+
+    def _finish_run(self, run, arc, feedrate_word, e_value, absolute_e):
+        # write out the buffered moves, either as single arc or unchanged
+        if arc is None or len(run) - 1 < self.min_segments:
+            for point in run[1:]:
+                yield point[3]
+            return
+        (cx, cy), sweep = arc
+        x0, y0 = run[0][:2]
+        x1, y1 = run[-1][:2]
+        e = e_value if absolute_e else sum(point[2] for point in run[1:])
+        outline = "%s X%s Y%s I%s J%s E%s" % ("G3" if sweep > 0 else "G2",
+                                             _format_number(x1, 4), _format_number(y1, 4),
+                                             _format_number(cx - x0, 4), _format_number(cy - y0, 4),
+                                             _format_number(e, 5))
+        if feedrate_word is not None:
+            outline += " F" + _format_number(feedrate_word, 4)
+        self.arcs += 1
+        yield outline
+
+    def weld_lines(self, lines, logger=None):
+        """ returns an iterator over lines with all arcs welded """
+        if logger is None:
+            logger = logging.getLogger()
+        for line in self._weld(lines):
+            self.bytes_out += len(line) + 1
+            yield line
+        logger.info("arc fitting replaced moves by %i arcs, %i -> %i bytes (%i bytes saved)",
+                    self.arcs, self.bytes_in, self.bytes_out, self.bytes_saved)
+
+    def _weld(self, lines):
+        # x, y and z are None while unknown, i.e. after homing or in relative mode
+        x = y = z = e = 0.
+        feedrate = None
+        absolute, absolute_e = True, True
+        # buffered moves, starting with the position they start from. arc is the fit of all buffered moves
+        run, arc, run_feedrate_word = [], None, None
+
+        for line in lines:
+            line = line.rstrip("\n")
+            self.bytes_in += len(line) + 1
+            command, params = _split_words(line)
+
+            if (command == "G1" and absolute and x is not None and y is not None and "E" in params
+                    and params.keys() <= set("XYZEF")
+                    and ("X" in params or "Y" in params) and params.get("Z", z) == z):
+                nx, ny = params.get("X", x), params.get("Y", y)
+                extrusion = params["E"] - e if absolute_e else params["E"]
+                if extrusion > 0 and (nx, ny) != (x, y):
+                    if run and (len(run) > self.max_segments or params.get("F", feedrate) != feedrate):
+                        yield from self._finish_run(run, arc, run_feedrate_word, e, absolute_e)
+                        run, arc = [], None
+                    # the feedrate only needs to be written for the arc if it is changed by its first move
+                    new_feedrate = params.get("F") if params.get("F", feedrate) != feedrate else None
+                    if not run:
+                        run, run_feedrate_word = [(x, y, 0., None)], new_feedrate
+                    run.append((nx, ny, extrusion, line))
+                    if len(run) > 2:
+                        fit = self.fit(run)
+                        if fit is None:
+                            # close the arc that fitted so far and continue from its end with this move
+                            last = run.pop()
+                            yield from self._finish_run(run, arc, run_feedrate_word, e, absolute_e)
+                            run, arc, run_feedrate_word = [(x, y, 0., None), last], None, new_feedrate
+                        else:
+                            arc = fit
+                    x, y = nx, ny
+                    e = params["E"] if absolute_e else e + extrusion
+                    feedrate = params.get("F", feedrate)
+                    continue
 
-        return "\n".join(result)
+            if run:
+                yield from self._finish_run(run, arc, run_feedrate_word, e, absolute_e)
+                run, arc = [], None
+
+            # keep track of the position through all other commands
+            if command in ("G0", "G1", "G2", "G3"):
+                if absolute:
+                    x, y, z = params.get("X", x), params.get("Y", y), params.get("Z", z)
+                if "E" in params:
+                    e = params["E"] if absolute_e else e + params["E"]
+                feedrate = params.get("F", feedrate)
+            elif command == "G92":
+                x, y, z, e = params.get("X", x), params.get("Y", y), params.get("Z", z), params.get("E", e)
+            elif command == "G28":
+                x = y = z = None
+            elif command == "G90":
+                absolute = absolute_e = True
+            elif command == "G91":
+                absolute = absolute_e = False
+                x = y = z = None
+            elif command == "M82":
+                absolute_e = True
+            elif command == "M83":
+                absolute_e = False
+            yield line
+
+        if run:
+            yield from self._finish_run(run, arc, run_feedrate_word, e, absolute_e)
+
+    def weld_gcode(self, gcode, logger=None):
+        return "\n".join(self.weld_lines(gcode.split("\n"), logger=logger))
+
+    def weld_file(self, in_file, out_file, logger=None):
+        write_lines(self.weld_lines(in_file, logger=logger), out_file)
 
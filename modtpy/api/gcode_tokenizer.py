@@ -0,0 +1,128 @@
+import re
+from typing import NamedTuple, Optional
+
+# bits of Instruction.flags, telling which axis words a line contains
+FLAG_X, FLAG_Y, FLAG_Z, FLAG_E, FLAG_F = 1, 2, 4, 8, 16
+
+# slot of each axis word in Instruction, keyed by letter as str, bytes and byte value (bytes[0] is an int)
+_AXES = {}
+for _slot, _letter in enumerate("XYZEF"):
+    for _key in (_letter, _letter.lower()):
+        _AXES[_key] = _AXES[ord(_key)] = _AXES[_key.encode()] = _slot
+
+# fallback for lines without spaces between words, e.g. G1X10Y5
+_WORD = re.compile(r"([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+_BYTES_WORD = re.compile(_WORD.pattern.encode())
+_NEWLINE = re.compile(b"\n")
+
+# normalized command per raw command word, e.g. "G01" -> "G1", b"g1" -> "G1"
+_commands = {}
+_MAX_CACHED_COMMANDS = 4096
+
+
+class Instruction(NamedTuple):
+    """ a parsed gcode line. command is the normalized command word (e.g. "G1"), or None for empty or comment lines.
+    flags tells which of the axis words X, Y, Z, E, F were given, their values are 0. otherwise """
+    command: Optional[str]
+    flags: int
+    x: float
+    y: float
+    z: float
+    e: float
+    f: float
+
+
+EMPTY = Instruction(None, 0, 0., 0., 0., 0., 0.)
+
+
+def _normalize_command(word):
+    command = _commands.get(word)
+    if command is None:
+        text = word.decode("ascii") if isinstance(word, bytes) else word
+        letter, number = text[0].upper(), text[1:]
+        # raises ValueError for something like G1X10, which is handled by the caller
+        number = str(int(number)) if number.isdigit() else str(float(number))
+        command = letter + number
+        if len(_commands) < _MAX_CACHED_COMMANDS:
+            _commands[word] = command
+    return command
+
+
+def _tokenize_words(line, is_bytes):
+    # slow path for words that are not separated by whitespace
+    words = (_BYTES_WORD if is_bytes else _WORD).findall(line)
+    if not words:
+        return EMPTY
+    letter, number = words[0]
+    values = [0., 0., 0., 0., 0.]
+    flags = 0
+    for key, value in words[1:]:
+        slot = _AXES.get(key)
+        if slot is not None:
+            values[slot] = float(value)
+            flags |= 1 << slot
+    return Instruction(_normalize_command(letter + number), flags, *values)
+
+
+def tokenize_line(line):
+    """ parses a single gcode line (str or bytes, with or without line break) into an Instruction in one pass.
+    comments after ; and any amount of whitespace are ignored """
+    is_bytes = not isinstance(line, str)
+    comment = line.find(b";" if is_bytes else ";")
+    if comment >= 0:
+        line = line[:comment]
+    words = line.split()
+    if not words:
+        return EMPTY
+
+    values = [0., 0., 0., 0., 0.]
+    flags = 0
+    try:
+        command = _normalize_command(words[0])
+        for word in words[1:]:
+            slot = _AXES.get(word[0])
+            if slot is not None:
+                values[slot] = float(word[1:])
+                flags |= 1 << slot
+    except (ValueError, IndexError):
+        return _tokenize_words(line, is_bytes)
+    return Instruction(command, flags, *values)
+
+
+def iter_lines(buffer):
+    """ yields the lines (without line break) of a bytes, bytearray, mmap or memoryview buffer as bytes without
+    decoding or copying the buffer as a whole """
+    start, end = 0, len(buffer)
+    if hasattr(buffer, "find"):
+        find = buffer.find
+    else:
+        # memoryviews can't be searched directly, but regular expressions work on any buffer
+        search = _NEWLINE.search
+
+        def find(_, pos):
+            match = search(buffer, pos)
+            return match.start() if match else -1
+    while start < end:
+        stop = find(b"\n", start)
+        if stop < 0:
+            stop = end
+        yield bytes(buffer[start:stop])
+        start = stop + 1
+
+
+def iter_text_lines(buffer, encoding="utf-8"):
+    """ like iter_lines, but yields decoded lines without carriage returns, like a file opened in text mode """
+    for line in iter_lines(buffer):
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        yield line.decode(encoding)
+
+
+def tokenize(lines):
+    """ yields an Instruction for each of the given str or bytes lines """
+    for line in lines:
+        yield tokenize_line(line)
+
+
+def tokenize_buffer(buffer):
+    return tokenize(iter_lines(buffer))
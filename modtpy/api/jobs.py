@@ -0,0 +1,262 @@
+import collections
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from zlib import adler32
+
+from modtpy.api.errors import PrinterError, UploadCancelled
+
+SPOOL_DIR = os.sep.join([os.path.expanduser("~"), ".modtpy", "spool"])
+COPY_SIZE = 1024 * 1024
+
+
+class JobState:
+    QUEUED = "queued"
+    # the printer is reset while the gcode is optimized or checksummed
+    PREPARING = "preparing"
+    UPLOADING = "uploading"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class SpoolFile:
+    """ binary file in the spool directory that keeps track of the size and mod-t adler32 checksum of the data
+    written to it, so that spooled uploads needn't be read again to checksum them. it can be handed to a parser that
+    streams an upload into it, e.g. as the stream_factory of werkzeug """
+
+    def __init__(self, job_id, path):
+        self.job_id = job_id
+        self.path = path
+        self.file = open(path, "wb+")
+        self.size = 0
+        self.adler32 = 0  # the mod-t uses 0, not 1 as the basis of the adler32 sum
+
+    @classmethod
+    def create(cls, spool_dir=SPOOL_DIR):
+        """ a new spool file with a new job id in spool_dir """
+        job_id = uuid.uuid4().hex[:12]
+        return cls(job_id, os.path.join(spool_dir, job_id + ".gcode"))
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.adler32 = adler32(data, self.adler32)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class PrintJob:
+    """ a gcode file spooled to path that waits for or is being sent to the printer. options are passed on to the
+    prepare function of the JobQueue, e.g. the optimizer backend """
+
+    def __init__(self, job_id, filename, path, checksum=None, options=None):
+        self.id = job_id
+        self.filename = filename
+        self.path = path
+        # adler32 checksum of the spooled file if it is known
+        self.checksum = checksum
+        self.options = dict(options or ())
+        self.state = JobState.QUEUED
+        self.sent = self.total = 0
+        self.kb_per_s = None
+        self.error = None
+        self.created = time.time()
+        self.started = self.finished = None
+        self.stats = None
+        self._cancel = threading.Event()
+        self._upload_start = None
+
+    @property
+    def progress(self):
+        return int(self.sent / self.total * 100) if self.total else 0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def watch(self, lines):
+        """ yields lines until the job is cancelled, e.g. to abort the optimization of a job that is being prepared """
+        for line in lines:
+            if self.cancelled:
+                raise UploadCancelled()
+            yield line
+
+    def update(self, sent, total):
+        """ progress callback of ModT.send_gcode, aborts the upload once the job is cancelled """
+        if self.cancelled:
+            raise UploadCancelled()
+        now = time.perf_counter()
+        if self._upload_start is None:
+            self._upload_start = now
+            self.state = JobState.UPLOADING
+        self.sent, self.total = sent, total
+        if now > self._upload_start:
+            self.kb_per_s = sent / 1024 / (now - self._upload_start)
+
+    def to_dict(self):
+        return dict(id=self.id, filename=self.filename, state=self.state, progress=self.progress, sent=self.sent,
+                    total=self.total, kb_per_s=self.kb_per_s, error=self.error, created=self.created,
+                    started=self.started, finished=self.finished,
+                    timings=self.stats.timings if self.stats is not None else None)
+
+
+def send_spooled(job: PrintJob):
+    """ default prepare function of a JobQueue, sends the spooled file as is """
+    return job.path, job.checksum
+
+
+class JobQueue:
+    """ print jobs that are sent to the printer one after another by a single worker thread. submit only spools the
+    upload to a file in spool_dir and returns, so that e.g. a web request doesn't wait for the printer. uploads that
+    are streamed into a SpoolFile from spool() are submitted without being copied again.
+    prepare(job) returns the (gcode_file, checksum) tuple to send for a job, like the prepare function of
+    ModT.send_prepared_gcode. lengthy preparations should pass their lines through job.watch, so that cancelling the
+    job aborts them. the last keep_finished finished jobs are kept for reporting """
+
+    def __init__(self, modt, prepare=send_spooled, spool_dir=SPOOL_DIR, keep_finished=50, logger=None):
+        self.modt = modt
+        self.prepare = prepare
+        self.spool_dir = spool_dir
+        self.keep_finished = keep_finished
+        self.logger = logger if logger is not None else logging.getLogger()
+        self._jobs = collections.OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def spool(self) -> SpoolFile:
+        """ a new SpoolFile for a job, to be passed to submit once it is written """
+        return SpoolFile.create(self.spool_dir)
+
+    def submit(self, stream, filename, **options) -> PrintJob:
+        """ enqueues the gcode read from the binary file object stream, or the written SpoolFile stream """
+        if isinstance(stream, SpoolFile):
+            spool = stream
+            spool.close()
+        else:
+            with self.spool() as spool:
+                shutil.copyfileobj(stream, spool, COPY_SIZE)
+        return self.submit_spooled(spool.job_id, spool.path, filename, checksum=spool.adler32, **options)
+
+    def submit_spooled(self, job_id, path, filename, checksum=None, **options) -> PrintJob:
+        """ enqueues the gcode that has been spooled to path, e.g. by another process. the file is removed once the
+        job is finished """
+        job = PrintJob(job_id, filename, path, checksum=checksum, options=options)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="print-jobs", daemon=True)
+                self._worker.start()
+        self._queue.put(job)
+        return job
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get(self, job_id) -> PrintJob:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise PrinterError("no job %s" % job_id, status_code=404)
+        return job
+
+    def cancel(self, job_id) -> PrintJob:
+        job = self.get(job_id)
+        with self._lock:
+            job.cancel()
+            if job.state == JobState.QUEUED:
+                # the worker skips it, but it should be reported as cancelled right away
+                job.state = JobState.CANCELLED
+        return job
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.state in JobState.FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            state = JobState.FAILED
+            try:
+                state = self._process(job)
+            finally:
+                try:
+                    os.remove(job.path)
+                except OSError:
+                    pass
+                # the state last, so that a finished job is complete when it is reported as such
+                job.finished = time.time()
+                job.state = state
+
+    def _process(self, job: PrintJob):
+        """ sends job to the printer and returns its final state """
+        with self._lock:
+            # in one step with the check, so that a job cancelled meanwhile is never reported as preparing again
+            if job.cancelled:
+                return JobState.CANCELLED
+            job.started = time.time()
+            job.state = JobState.PREPARING
+        self.logger.info("starting job %s (%s)", job.id, job.filename)
+        try:
+            job.stats = self.modt.send_prepared_gcode(lambda: self.prepare(job), logger=self.logger,
+                                                      progress=job.update)
+            self.modt.press_button()
+            return JobState.DONE
+        except UploadCancelled:
+            self.logger.info("cancelled job %s", job.id)
+            if job._upload_start is not None:
+                try:
+                    # flush the partially received file. jobs cancelled while they were prepared have only been reset
+                    self.modt.reset()
+                except Exception as e:
+                    self.logger.warning("couldn't reset printer after cancelling job %s: %s", job.id, e)
+            return JobState.CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            self.logger.exception("job %s failed", job.id)
+            return JobState.FAILED
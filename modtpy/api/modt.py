@@ -1,7 +1,10 @@
+import array
+import contextlib
 import os
 import sys
 import time
 import json
+import tempfile
 from io import StringIO
 from os import PathLike
 from typing import Union, BinaryIO
@@ -15,12 +18,19 @@ import threading
 import logging
 
 from modtpy import api
+from modtpy.api.channel import ChannelThread, COMMAND_TIMEOUT
+from modtpy.api.device_owner import DeviceOwner, StatusSnapshot, device_command
+from modtpy.api.errors import PrinterError
+from modtpy.api.modt_commands import Endpoints, STATUS_REQUEST, RESPONSE_READ_SIZE, response_complete
+from modtpy.api.status_history import StatusHistory
+from modtpy.api.transfer import UploadSettings, UploadStats, Throughput, format_timings
 from modtpy.api.usb import USBDevice, Mode
-from modtpy.api.utils import TqdmLogger
+from modtpy.api.utils import TqdmLogger, gcode_buffer
 
 from modtpy.res import lib_usb_dir, dfu_util_dir
 
 BLOCKSIZE = 256 * 1024 * 1024
+CHECKSUM_BLOCKSIZE = 1024 * 1024
 
 if os.name == 'nt':
     is_64_bit = sys.maxsize > 2 ** 32
@@ -29,15 +39,53 @@ if os.name == 'nt':
     os.environ['PATH'] = os.pathsep.join([os.environ['PATH'], lib_usb_dir, dfu_util_dir])
 
 
-def adler32_checksum(data: bytes):
+def adler32_checksum(data: bytes, adler_sum=0):
     # Adler32 checksum function based on https://gist.github.com/kofemann/2303046
     # For some reason, mod-t uses 0, not 1 as the basis of the adler32 sum
-    adler_sum = adler32(data, 0)
+    # data may be any bytes-like object. it is checksummed in blocks using the running value of adler32, so that a
+    # memory-mapped file is streamed through once without being copied. pass adler_sum to continue a checksum
+    with memoryview(data) as view:
+        for start in range(0, len(view), CHECKSUM_BLOCKSIZE):
+            adler_sum = adler32(view[start:start + CHECKSUM_BLOCKSIZE], adler_sum)
     if adler_sum < 0:
         adler_sum += 2 ** 32
     return adler_sum
 
 
+def spool_gcode(stream: BinaryIO):
+    """ copies the binary stream in blocks to an anonymous temporary file while computing its adler32_checksum.
+    used for streams that can be neither seeked nor memory-mapped. returns the rewound file and the checksum """
+    spool = tempfile.TemporaryFile()
+    try:
+        adler_sum = 0
+        for block in iter(lambda: stream.read(CHECKSUM_BLOCKSIZE), b""):
+            adler_sum = adler32_checksum(block, adler_sum)
+            spool.write(block)
+        spool.seek(0)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, adler_sum
+
+
+def gcode_checksum(gcode_file: Union[PathLike, BinaryIO]):
+    """ adler32_checksum of a path or seekable binary file object from its current position, which is kept """
+    start = None if isinstance(gcode_file, (str, PathLike)) else gcode_file.tell()
+    try:
+        with gcode_buffer(gcode_file) as buffer:
+            return adler32_checksum(buffer)
+    finally:
+        if start is not None:
+            gcode_file.seek(start)
+
+
+def is_seekable(gcode_file):
+    try:
+        return gcode_file.seekable()
+    except AttributeError:
+        return False
+
+
 STATUS_STRINGS = dict(STATE_LOADFIL_HEATING="Load filament: heating",
                       STATE_LOADFIL_EXTRUDING="Load filament: extruding",
                       STATE_REMFIL_HEATING="Unload filament: heating",
@@ -57,73 +105,109 @@ STATUS_STRINGS = dict(STATE_LOADFIL_HEATING="Load filament: heating",
                       STATE_MECH_READY="Print finished")
 
 
-class Endpoints:
-    COMMAND_READ = 0x81
-    COMMAND_WRITE = 0x2
-    BASIC_READ = 0x83
-    BASIC_WRITE = 0x4
-
-
 class ModT(USBDevice):
     dev_vendor_id = 0x2b75
     running_id = 1
+    # the usb dump shows command headers and payloads in separate writes. whether the printer also accepts them in a
+    # single write is untested, so it is opt-in
+    single_write_commands = False
 
     def __init__(self):
         self.current_gcode_path = None
         self.current_gcode_len = None
-        self.last_status = dict(status=dict(state="disconnected"))
-        self.last_status_time = 0
+        self.status_snapshot = StatusSnapshot(dict(status=dict(state="disconnected")), 0)
         self.status_poll_interval = .5
+        self.upload_settings = UploadSettings()
+        self.owner = DeviceOwner(self.poll_status, self.status_poll_interval)
+        self.channel = ChannelThread(self)
+        self.status_history = StatusHistory()
+        self._status_published = threading.Condition()
+
+    @property
+    def last_status(self):
+        return self.status_snapshot.status
+
+    @property
+    def last_status_time(self):
+        return self.status_snapshot.time
+
+    def publish_status(self, status: dict):
+        # a single reference assignment, readers see either the old or the new snapshot but never a partial one
+        now = time.time()
+        self.status_snapshot = StatusSnapshot(status, now)
+        with self._status_published:
+            self._status_published.notify_all()
+        # at most one sample per poll interval, e.g. not one per usb write for the progress updates of an upload
+        if now - self.status_history.last_time >= self.status_poll_interval:
+            self.status_history.append(status, now)
+
+    def wait_for_status(self, snapshot: StatusSnapshot = None, timeout=None):
+        """ waits until a snapshot other than snapshot is published and returns the latest one, which is still
+        snapshot if the timeout passed """
+        with self._status_published:
+            self._status_published.wait_for(lambda: self.status_snapshot is not snapshot, timeout)
+        return self.status_snapshot
+
+    def poll_status(self):
+        """ queries and publishes the status, whether or not the latest snapshot is recent """
+        status = super().get_status()
+        self.publish_status(status)
+        return status
 
     def run_status_loop(self, daemon=False):
+        """ starts the DeviceOwner thread, which polls the status every status_poll_interval seconds and runs the
+        device commands. afterwards get_status returns the latest snapshot without waiting for the device.
+        daemon=True runs the loop in the calling thread instead and never returns """
+        self.owner.poll_interval = self.status_poll_interval
         if daemon:
-            while True:
-                try:
-                    self.last_status = self.get_status()
-                    self.last_status_time = time.time()
-                except Exception as e:
-                    logging.debug("couldn't get status: %s" % e)
-                time.sleep(self.status_poll_interval)
-        else:
-            thread = threading.Thread(target=self.run_status_loop, kwargs=dict(daemon=True))
-            thread.daemon = True
-            thread.start()
-            return thread
+            self.owner.thread = threading.current_thread()
+            self.owner._run()
+        return self.owner.start()
 
     def has_correct_mode(self, required_mode=None):
         return required_mode is None or self.mode == required_mode
 
     @classmethod
     def _send_command(cls, device, command_name, arguments=None):
-        checksum, payload = api.modt_commands.get_payload(command_name, cls.running_id, args=arguments)
-        device.write(Endpoints.COMMAND_WRITE, bytearray.fromhex(checksum))
-        device.write(Endpoints.COMMAND_WRITE, payload)
+        header, payload = api.modt_commands.encode_command(command_name, cls.running_id, args=arguments)
+        if cls.single_write_commands:
+            device.write(Endpoints.COMMAND_WRITE, header + payload)
+        else:
+            device.write(Endpoints.COMMAND_WRITE, header)
+            device.write(Endpoints.COMMAND_WRITE, payload)
         cls.running_id += 2
 
-    @classmethod
-    def _exec_command(cls, device, command_name, arguments=None):
-        cls._send_command(device, command_name, arguments)
-        # first 5 chars belong to checksum
-        return cls._read_response(device, Endpoints.COMMAND_READ)[5:]
+    def _exec_command(self, command_name, arguments=None, timeout=COMMAND_TIMEOUT):
+        """ sends a command through the command channel and returns its reply without the header. the reply is
+        matched to the command by its id, so that other commands and status requests can be in flight meanwhile """
+        return self.channel.command(command_name, arguments, timeout=timeout)
 
+    @contextlib.contextmanager
+    def exclusive_device(self, required_mode=Mode.OPERATE):
+        """ get_device for reading and writing the endpoints directly, e.g. for uploads. the command channel is closed
+        meanwhile, so that its readers don't take the messages, and its requests wait until the device is released """
+        with self.channel.paused(), self.get_device(required_mode) as dev:
+            yield dev
+
+    @device_command
     def enter_dfu(self, wait_for_dfu=False):
         if self.mode is Mode.DFU:
             return
 
-        with self.get_device() as dev:
+        # the printer reboots instead of replying, so the command is sent directly
+        with self.exclusive_device() as dev:
             self._send_command(dev, "Enter_dfu_mode")
+            self.drop_device()
 
         # Wait for the Mod-T to reattach in DFU mode
         if wait_for_dfu:
             time.sleep(wait_for_dfu if isinstance(wait_for_dfu, (int, float)) else 2)
 
-    def load_filament(self):
-        with self.get_device() as dev:
-            self._send_command(dev, "load_initiate")
+    def load_filament(self, timeout=COMMAND_TIMEOUT):
+        self._exec_command("load_initiate", timeout=timeout)
 
-    def unload_filament(self):
-        with self.get_device() as dev:
-            self._send_command(dev, "unload_initiate")
+    def unload_filament(self, timeout=COMMAND_TIMEOUT):
+        self._exec_command("unload_initiate", timeout=timeout)
 
     def format_status_msg(self, msg: dict, progress=True):
         status, job = msg.get("status", {}), msg.get("job", {})
@@ -138,78 +222,162 @@ class ModT(USBDevice):
                                      ])))
 
     def _get_status(self, device, handle_exception=True, as_dict=True):
-        device.write(Endpoints.BASIC_WRITE, '{"metadata":{"version":1,"type":"status"}}')
-        msg = self._read_response(device, Endpoints.BASIC_READ)
-        msg = api.utils.parse_json(msg)
+        device.write(Endpoints.BASIC_WRITE, STATUS_REQUEST)
+        return self._decode_status(self._read_response(device, Endpoints.BASIC_READ), as_dict=as_dict)
+
+    def _decode_status(self, message: bytes, as_dict=True):
+        msg = api.utils.parse_json(message.decode("latin-1"))
         if as_dict:
             msg = msg.to_dict()
             msg["msg_str_format"] = self.format_status_msg(msg)
         return msg
 
+    def _query_status(self):
+        # through the command channel, so that status requests don't wait for the replies to commands
+        return self.channel.status()
+
     def get_status(self, device=None):
-        if (time.time() - self.last_status_time) < self.status_poll_interval:
-            print("returning cached status from t=%s" % self.last_status_time)
-            return self.last_status
-        else:
-            return super().get_status(device=device)
+        """ without a device, the latest status snapshot is returned if the status loop runs or if it is recent, so
+        that readers never wait for the device. otherwise the printer is queried and the result published """
+        snapshot = self.status_snapshot
+        if device is None and (self.owner.running and not self.owner.is_owner()
+                               or snapshot.age < self.status_poll_interval):
+            return snapshot.status
+        status = super().get_status(device=device)
+        self.publish_status(status)
+        return status
 
     @staticmethod
-    def _read_response(device, endpoint):
-        # Read pending data from MOD-t (bulk reads of 64 bytes)
-        text = ''.join(map(chr, device.read(endpoint, 64)))
-        fulltext = text
-        while len(text) == 64:
-            text = ''.join(map(chr, device.read(endpoint, 64)))
-            fulltext = fulltext + text
-        logging.debug("read data from device: " + fulltext)
-        return fulltext
+    def _read_response(device, endpoint, read_size=RESPONSE_READ_SIZE, timeout=None):
+        """ reads a complete message from endpoint and returns it as bytes. reads go into a preallocated array of
+        read_size bytes, so that short messages take a single transfer instead of one per 64 byte packet.
+        timeout is in milliseconds, None for the default of pyusb """
+        chunk = array.array("B", bytes(read_size))
+        message = bytearray()
+        with memoryview(chunk) as chunk_view:
+            while True:
+                n_read = device.read(endpoint, chunk, timeout)
+                message += chunk_view[:n_read]
+                # a short transfer ends the message, as does its framing if it is exactly read_size bytes long
+                if n_read < read_size or response_complete(message):
+                    break
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("read data from device: %r", bytes(message))
+        return bytes(message)
 
     def read_response(self, endpoint):
         assert endpoint in (Endpoints.BASIC_READ, Endpoints.COMMAND_READ)
 
         try:
-            with self.get_device(Mode.OPERATE) as dev:
-                return self._read_response(dev, endpoint)
+            with self.exclusive_device(Mode.OPERATE) as dev:
+                return self._read_response(dev, endpoint).decode("latin-1")
         except usb.core.USBError as e:
             return json.dumps(dict(error=str(e)))
 
+    @device_command
     def reset(self, wait_for_reboot=False):
-        with self.get_device() as dev:
+        self._reset(wait_for_reboot)
+
+    def _reset(self, wait_for_reboot=False):
+        # the printer reboots instead of replying, so the command is sent directly
+        with self.exclusive_device() as dev:
             self._send_command(dev, 'Reset_printer')
+            self.drop_device()
 
         if wait_for_reboot:
             time.sleep(3)
 
-    def press_button(self):
-        with self.get_device() as dev:
-            self._send_command(dev, 'gcode_process_command',
-                               arguments=dict(command=[ord(c) for c in api.modt_commands.press_button_gcode] + [0]))
-
-    def send_gcode(self, gcode_file: Union[PathLike, BinaryIO], logger=None):
+    def press_button(self, timeout=COMMAND_TIMEOUT):
+        self._exec_command('gcode_process_command',
+                           arguments=dict(command=[ord(c) for c in api.modt_commands.press_button_gcode] + [0]),
+                           timeout=timeout)
+
+    @device_command
+    def send_gcode(self, gcode_file: Union[PathLike, BinaryIO], logger=None, checksum=None,
+                   settings: UploadSettings = None, reset=True, progress=None):
+        """ sends gcode_file to the printer. checksum may be given if the adler32_checksum of the file is known
+        already (e.g. from the gcode cache) to skip computing it. settings default to self.upload_settings.
+        reset=False skips resetting the printer, which must have been done before (see send_prepared_gcode).
+        progress(sent, total) is called after every write, it may raise (e.g. UploadCancelled) to abort the upload.
+        returns the UploadStats of the transfer """
         if logger is None:
             logger = logging.getLogger()
-
-        logger.info("resetting device to flush old jobs")
-        self.reset(wait_for_reboot=True)
-        logger.info("done")
-
-        def update_progress(progress):
-            self.last_status.update(dict(status=dict(state="STATE_FILE_RX"), job=dict(progress=progress)))
-            self.last_status_time = time.time()
-
-        update_progress(0)
-        if type(gcode_file) is str and os.path.isfile(gcode_file):
-            with open(gcode_file, "rb") as f:
-                gcode = f.read()
+        if settings is None:
+            settings = self.upload_settings
+
+        if reset:
+            logger.info("resetting device to flush old jobs")
+            self._reset(wait_for_reboot=True)
+            logger.info("done")
+
+        def update_progress(sent, total):
+            self.publish_status(dict(self.last_status, status=dict(state="STATE_FILE_RX"),
+                                     job=dict(progress=int(sent / max(total, 1) * 100))))
+            if progress is not None:
+                progress(sent, total)
+
+        update_progress(0, 0)
+        if type(gcode_file) is str and os.path.isfile(gcode_file) or is_seekable(gcode_file):
+            # the gcode is memory-mapped where possible, checksum and usb writes work on slices of the mapped buffer
+            with gcode_buffer(gcode_file) as gcode:
+                return self._send_gcode_buffer(gcode, gcode_file, logger, checksum, settings, update_progress)
         elif hasattr(gcode_file, "read"):
-            gcode = gcode_file.read()
+            # e.g. an upload stream, which is spooled to disk in a single pass that also computes the checksum
+            spool_start = time.perf_counter()
+            spool, spool_checksum = spool_gcode(gcode_file)
+            timings = dict(spool=time.perf_counter() - spool_start)
+            with spool, gcode_buffer(spool) as gcode:
+                return self._send_gcode_buffer(gcode, gcode_file, logger,
+                                               checksum if checksum is not None else spool_checksum, settings,
+                                               update_progress, timings)
         else:
             raise ValueError("Invalid gcode_file %s" % gcode_file)
 
-        checksum = adler32_checksum(gcode)
+    def send_prepared_gcode(self, prepare, logger=None, settings: UploadSettings = None, progress=None):
+        """ sends the gcode returned by prepare() to the printer, e.g. after optimizing it. prepare returns a
+        (gcode_file, checksum) tuple as taken by send_gcode, with checksum None if it is unknown.
+        prepare runs in the calling thread while the printer is reset in the owner thread, so that the reboot wait is
+        hidden behind the preparation and the status loop keeps polling during a lengthy one. only the reset and the
+        upload itself hold the device. the time of each stage is logged and added to the timings of the returned
+        UploadStats """
+        if logger is None:
+            logger = logging.getLogger()
+        timings = {}
+
+        def reset():
+            reset_start = time.perf_counter()
+            self._reset(wait_for_reboot=True)
+            timings["reset"] = time.perf_counter() - reset_start
+
+        logger.info("resetting device to flush old jobs")
+        reset_done = self.owner.submit(reset)
+        try:
+            prepare_start = time.perf_counter()
+            gcode_file, checksum = prepare()
+            timings["prepare"] = time.perf_counter() - prepare_start
+        finally:
+            wait_start = time.perf_counter()
+            reset_error = reset_done.exception()
+            timings["reset_wait"] = time.perf_counter() - wait_start
+        if reset_error is not None:
+            raise reset_error
+
+        stats = self.send_gcode(gcode_file, logger=logger, checksum=checksum, settings=settings, reset=False,
+                                progress=progress)
+        stats.timings = {**timings, **stats.timings}
+        logger.info("upload stages: %s", format_timings(stats.timings))
+        return stats
+
+    def _send_gcode_buffer(self, gcode: memoryview, gcode_file, logger, checksum, settings: UploadSettings,
+                           update_progress, timings=None):
+        timings = dict(timings or ())
+        if checksum is None:
+            checksum_start = time.perf_counter()
+            checksum = adler32_checksum(gcode)
+            timings["checksum"] = time.perf_counter() - checksum_start
         gcode_file_size = len(gcode)
 
-        update_progress(0)
+        update_progress(0, gcode_file_size)
 
         # The following came from a usb-dump and is probably not necessary
         # Some commands are human readable some are maybe checksums
@@ -238,46 +406,59 @@ class ModT(USBDevice):
 
         """
 
-        with self.get_device(Mode.OPERATE) as dev:
-            logger.debug(self._exec_command(dev, "bio_get_version"))
-            logger.debug(self.format_status_msg(self.get_status(device=dev)))
-            logger.debug(self._exec_command(dev, "wifi_client_get_status", arguments=dict(interface_t=0)))
-            logger.debug(self._exec_command(dev, "bio_get_version"))
-            for i in range(2):
-                logger.debug(self.format_status_msg(self.get_status(device=dev)))
-                update_progress(0)
+        logger.debug(self._exec_command("bio_get_version"))
+        logger.debug(self.format_status_msg(self.poll_status()))
+        logger.debug(self._exec_command("wifi_client_get_status", arguments=dict(interface_t=0)))
+        logger.debug(self._exec_command("bio_get_version"))
+        for i in range(2):
+            logger.debug(self.format_status_msg(self.poll_status()))
+            update_progress(0, gcode_file_size)
 
+        with self.exclusive_device(Mode.OPERATE) as dev:
             # prepare printer for sending gcode
             dev.write(Endpoints.BASIC_WRITE,
                       '{"metadata":{"version":1,"type":"file_push"},"file_push":'
                       '{"size":%i,"adler32":%i,"job_id":"","file":"%s"}}' % (gcode_file_size, checksum, gcode_file))
 
-            # Write gcode in batches of 20 bulk writes, each 5120 bytes. Read mod-t status between these 20 bulk writes
-            start = counter = 0
+            # Write gcode in bulk writes of settings.packets_per_write packets (by default 5120 bytes). Drain the
+            # mod-t status messages every few writes (by default 20), or as often as the adaptive schedule decides
+            write_size = settings.write_size(dev, Endpoints.BASIC_WRITE)
+            drain_schedule = settings.drain_scheduler()
+            throughput = Throughput()
+            sent = writes = drains = writes_since_drain = 0
             total = len(gcode)
 
             tqdm_out = TqdmLogger(logger)
 
-            with tqdm.tqdm(total=len(gcode), file=tqdm_out) as pbar:
-                while True:
-                    # set status time so that old (cached) status is returned
-                    end = start + 5120
-                    block = gcode[start:end]
-
-                    if counter > 0 and counter % 20 == 0:
+            blocks = settings.blocks(gcode, write_size)
+            with tqdm.tqdm(total=len(gcode), file=tqdm_out) as pbar, contextlib.closing(blocks):
+                for block in blocks:
+                    if writes_since_drain >= drain_schedule.interval:
+                        drain_schedule.update(throughput.window())
                         self._read_response(dev, Endpoints.BASIC_READ)
-
-                    dev.write(Endpoints.BASIC_WRITE, block)
-
-                    counter += 1
-                    start += 5120
-                    update_progress(progress=int(start / len(gcode) * 100))
-
-                    pbar.update(5120)
-                    pbar.set_description("Sent bytes %i / %i" % (end, total))
-                    if start > gcode_file_size:
-                        break
-            logger.info("upload complete")
+                        drains += 1
+                        writes_since_drain = 0
+
+                    try:
+                        dev.write(Endpoints.BASIC_WRITE, block, timeout=settings.write_timeout)
+                    except usb.core.USBTimeoutError as e:
+                        # the write may have been transferred partially, so it can't simply be retried
+                        raise PrinterError("upload timed out after %i of %i bytes" % (sent, total),
+                                           payload=dict(error=str(e)))
+
+                    writes += 1
+                    writes_since_drain += 1
+                    sent += len(block)
+                    throughput.add(len(block))
+                    # set status time so that old (cached) status is returned
+                    update_progress(sent, total)
+
+                    pbar.update(len(block))
+                    pbar.set_description("Sent bytes %i / %i" % (sent, total))
+            timings["transfer"] = throughput.elapsed()
+            stats = UploadStats(total, timings["transfer"], writes, drains, drain_schedule.interval, timings)
+            logger.info("upload complete: %i bytes in %.1f s (%.1f KB/s)", total, stats.seconds, stats.kb_per_s)
+            return stats
 
     def flash_firmware(self, firmware_path, override_confirm=False):
         firmware_path = os.path.abspath(firmware_path)
@@ -1,7 +1,20 @@
 import json
 
+from modtpy.api.utils import decode_json
+
 press_button_gcode = "S1 S123"
 
+STATUS_REQUEST = '{"metadata":{"version":1,"type":"status"}}'
+# 64 full speed packets, so that responses usually arrive in a single transfer
+RESPONSE_READ_SIZE = 4096
+
+
+class Endpoints:
+    COMMAND_READ = 0x81
+    COMMAND_WRITE = 0x2
+    BASIC_READ = 0x83
+    BASIC_WRITE = 0x4
+
 
 command_indexes = {
         'bio_get_version': 0, 'bio_get_serial': 1,
@@ -58,6 +71,7 @@ def get_checksum(command_payload):
 
 
 def get_payload(command_name, id, args=None):
+    # reference encoder returning hex checksum and payload as str, ModT sends commands encoded by encode_command
     idx = command_indexes[command_name]
     command = dict(transport=dict(attrs=["request", "twoway"], id=id),
                    data=dict(command=dict(idx=idx, name=command_name)))
@@ -67,3 +81,47 @@ def get_payload(command_name, id, args=None):
     command_payload = json.dumps(command).strip().replace(" ", "") + ";"
     command_checksum = get_checksum(command_payload)
     return command_checksum, command_payload
+
+
+# byte templates of encode_command, split around the running id and the arguments
+_ID_PREFIX = b'{"transport":{"attrs":["request","twoway"],"id":'
+_COMMAND_TEMPLATES = {name: b'},"data":{"command":{"idx":%i,"name":%s' % (idx, json.dumps(name).encode())
+                      for name, idx in command_indexes.items()}
+_ARGS_PREFIX = b',"args":'
+_SUFFIX = b"}}};"
+
+
+def command_header(size):
+    """ the 5 byte header of a command payload of size bytes, as bytes (see get_checksum) """
+    return bytes((36, size & 0xff, (size >> 8) & 0xff, 255 - (size & 0xff), 255))
+
+
+def encode_command(command_name, id, args=None):
+    """ returns the header and payload of a command as bytes. equivalent to get_payload, but only the running id and
+    the arguments are encoded per call, and spaces within string arguments are kept """
+    parts = [_ID_PREFIX, b"%i" % id, _COMMAND_TEMPLATES[command_name]]
+    if args is not None:
+        parts += [_ARGS_PREFIX, json.dumps(args, separators=(",", ":")).encode()]
+    parts.append(_SUFFIX)
+    payload = b"".join(parts)
+    return command_header(len(payload)), payload
+
+
+def response_complete(message):
+    """ tells from the framing whether message is complete: command responses start with a 5 byte header
+    ($, size, 0, 255 - size, 255, see get_checksum) and end with ; """
+    if message.endswith(b";"):
+        return True
+    if len(message) >= 5 and message[0] == 0x24 and message[4] == 0xff and message[1] + message[3] == 0xff:
+        return len(message) >= 5 + message[1] + (message[2] << 8)
+    return False
+
+
+def reply_id(reply):
+    """ transport id of a command reply (5 byte header followed by json) as bytes, or None if it has none """
+    data = decode_json(reply[5:].decode("latin-1"))
+    try:
+        transport_id = data["transport"]["id"]
+    except (TypeError, KeyError):
+        return None
+    return transport_id if isinstance(transport_id, int) else None
@@ -0,0 +1,81 @@
+import array
+import math
+import threading
+
+# columns of a StatusHistory and the section of the status message that each is taken from
+FIELDS = (("timestamp", None),
+          ("state", "status"),
+          ("extruder_temperature", "status"),
+          ("extruder_target_temperature", "status"),
+          ("progress", "job"),
+          ("rx_progress", "job"),
+          ("current_line_number", "job"))
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class StatusHistory:
+    """ ring buffer of the last capacity status samples. every column is a preallocated array of doubles, so that
+    appending is O(1) and doesn't allocate. states are stored as codes into self.states, missing values as nan """
+
+    def __init__(self, capacity=3600):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.columns = {name: array.array("d", bytes(8 * capacity)) for name, _ in FIELDS}
+        self.states = []
+        self._state_codes = {}
+        # number of samples appended so far, the index of the next one in the ring is count % capacity
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def state_code(self, state):
+        code = self._state_codes.get(state)
+        if code is None:
+            code = self._state_codes[state] = len(self.states)
+            self.states.append(state)
+        return code
+
+    @property
+    def last_time(self):
+        return self.columns["timestamp"][(self.count - 1) % self.capacity] if self.count else -math.inf
+
+    def append(self, status: dict, timestamp: float):
+        with self._lock:
+            # inside the lock, so that concurrent appends never write the same slot
+            index = self.count % self.capacity
+            for name, section in FIELDS:
+                if section is None:
+                    value = timestamp
+                else:
+                    values = status.get(section)
+                    value = values.get(name) if isinstance(values, dict) else None
+                    if name == "state":
+                        value = math.nan if value is None else self.state_code(value)
+                self.columns[name][index] = _number(value)
+            self.count += 1
+
+    def since(self, timestamp=-math.inf):
+        """ the samples newer than timestamp as a dict of columns (lists), with state names instead of codes and None
+        for missing values. only the requested samples are visited, starting from the newest one """
+        with self._lock:
+            timestamps = self.columns["timestamp"]
+            indices = []
+            for i in range(self.count - 1, self.count - 1 - len(self), -1):
+                index = i % self.capacity
+                if timestamps[index] <= timestamp:
+                    break
+                indices.append(index)
+            indices.reverse()
+            result = {name: [self.columns[name][index] for index in indices] for name, _ in FIELDS}
+        result = {name: [None if math.isnan(value) else value for value in values] for name, values in result.items()}
+        result["state"] = [None if code is None else self.states[int(code)] for code in result["state"]]
+        return result
@@ -0,0 +1,191 @@
+import array
+import queue
+import threading
+import time
+
+import usb.core
+import usb.util
+
+# bulk endpoints of full speed devices such as the mod-t transfer at most 64 bytes per packet
+DEFAULT_MAX_PACKET_SIZE = 64
+
+
+def max_packet_size(device, endpoint_address):
+    """ wMaxPacketSize of the endpoint of device, or DEFAULT_MAX_PACKET_SIZE if it can't be determined """
+    try:
+        interface = device.get_active_configuration()[(0, 0)]
+        return usb.util.find_descriptor(interface, bEndpointAddress=endpoint_address).wMaxPacketSize
+    except (AttributeError, KeyError, NotImplementedError, usb.core.USBError):
+        return DEFAULT_MAX_PACKET_SIZE
+
+
+class UploadSettings:
+    """ transfer parameters of ModT.send_gcode. the defaults are the values of the original usb dump: every bulk write
+    holds 80 packets (5120 bytes) and the status messages of the printer are drained every 20 writes.
+    write_timeout is the timeout of each bulk write in milliseconds. with adaptive=True, the drain interval is tuned
+    during the upload by an AdaptiveDrainInterval, starting from drain_interval. with prefetch > 0, up to prefetch
+    blocks are read ahead of the usb writes by a producer thread (see prefetch_blocks) """
+
+    def __init__(self, packets_per_write=80, drain_interval=20, write_timeout=5000, adaptive=False,
+                 min_drain_interval=2, max_drain_interval=200, prefetch=0):
+        if packets_per_write < 1 or drain_interval < 1:
+            raise ValueError("packets_per_write and drain_interval must be positive")
+        self.packets_per_write = packets_per_write
+        self.drain_interval = drain_interval
+        self.write_timeout = write_timeout
+        self.adaptive = adaptive
+        self.min_drain_interval = min_drain_interval
+        self.max_drain_interval = max_drain_interval
+        self.prefetch = prefetch
+
+    def write_size(self, device, endpoint_address):
+        return self.packets_per_write * max_packet_size(device, endpoint_address)
+
+    def drain_scheduler(self):
+        if self.adaptive:
+            return AdaptiveDrainInterval(self.drain_interval, self.min_drain_interval, self.max_drain_interval)
+        return FixedDrainInterval(self.drain_interval)
+
+    def blocks(self, gcode, write_size):
+        if self.prefetch:
+            return prefetch_blocks(gcode, write_size, self.prefetch)
+        return iter_blocks(gcode, write_size)
+
+    def __repr__(self):
+        return ("UploadSettings(packets_per_write=%i, drain_interval=%i, write_timeout=%i, adaptive=%s, prefetch=%i)"
+                % (self.packets_per_write, self.drain_interval, self.write_timeout, self.adaptive, self.prefetch))
+
+
+def _fill(block, gcode, start):
+    block_size = min(len(block), len(gcode) - start)
+    with memoryview(block) as block_view:
+        block_view[:block_size] = gcode[start:start + block_size]
+    return block if block_size == len(block) else block[:block_size]
+
+
+def iter_blocks(gcode, write_size):
+    """ yields the bytes-like gcode in arrays of write_size bytes, the last one being shorter (or empty if the size
+    is a multiple of write_size). the blocks are copied into a single reused array, which pyusb passes on to libusb as
+    is, whereas memoryview or bytes slices would be converted to a new array on every write. each block is only
+    valid until the next one is requested """
+    block = array.array("B", bytes(write_size))
+    for start in range(0, len(gcode) + 1, write_size):
+        yield _fill(block, gcode, start)
+
+
+def prefetch_blocks(gcode, write_size, depth=4):
+    """ like iter_blocks, but a producer thread copies the blocks into a pool of depth + 1 arrays and hands them over
+    through a bounded queue, so that reading a memory-mapped file from disk overlaps with the usb writes """
+    free, full = queue.Queue(), queue.Queue(maxsize=depth)
+    for _ in range(depth + 1):
+        free.put(array.array("B", bytes(write_size)))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for start in range(0, len(gcode) + 1, write_size):
+                block = free.get()
+                if stop.is_set():
+                    return
+                full.put((block, _fill(block, gcode, start), None))
+            full.put((None, None, None))
+        except Exception as e:
+            full.put((None, None, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            block, filled, error = full.get()
+            if error is not None:
+                raise error
+            if block is None:
+                return
+            yield filled
+            # the consumer is done with the block, so the producer may reuse it
+            free.put(block)
+    finally:
+        stop.set()
+        free.put(None)
+        # keep draining so that the producer isn't blocked and stops slicing gcode before it may be unmapped
+        while producer.is_alive():
+            try:
+                full.get(timeout=.01)
+            except queue.Empty:
+                pass
+        producer.join()
+
+
+class FixedDrainInterval:
+    def __init__(self, interval):
+        self.interval = interval
+
+    def update(self, throughput):
+        pass
+
+
+class AdaptiveDrainInterval:
+    """ hill climbing on the number of writes between status drains. after each drain, the throughput of the writes
+    since the previous drain is compared to the one before. the interval keeps moving in the same direction while
+    throughput improves and turns around otherwise, so it settles around the optimum and follows it if it drifts """
+
+    def __init__(self, interval, minimum, maximum, factor=1.25):
+        self.interval = interval
+        self.minimum, self.maximum = minimum, maximum
+        self.factor = factor
+        self.last_throughput = None
+
+    def update(self, throughput):
+        if self.last_throughput is not None and throughput < self.last_throughput:
+            self.factor = 1 / self.factor
+        self.last_throughput = throughput
+        interval = int(round(self.interval * self.factor))
+        if interval == self.interval:
+            interval += 1 if self.factor > 1 else -1
+        self.interval = min(self.maximum, max(self.minimum, interval))
+
+
+class UploadStats:
+    def __init__(self, size, seconds, writes, drains, drain_interval, timings=None):
+        self.size = size
+        self.seconds = seconds
+        self.writes = writes
+        self.drains = drains
+        # drain interval at the end of the upload, which differs from the configured one with adaptive settings
+        self.drain_interval = drain_interval
+        # seconds spent in each stage of the upload, e.g. checksum and transfer
+        self.timings = dict(timings or ())
+
+    @property
+    def kb_per_s(self):
+        return self.size / 1024 / self.seconds if self.seconds > 0 else float("inf")
+
+    def __repr__(self):
+        return ("UploadStats(size=%i, seconds=%.2f, kb_per_s=%.1f, writes=%i, drains=%i, drain_interval=%i, timings=%s)"
+                % (self.size, self.seconds, self.kb_per_s, self.writes, self.drains, self.drain_interval,
+                   format_timings(self.timings)))
+
+
+def format_timings(timings):
+    return ", ".join("%s %.2f s" % item for item in timings.items())
+
+
+class Throughput:
+    """ measures bytes per second between calls of window """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start = self.window_start = clock()
+        self.window_bytes = 0
+
+    def add(self, n_bytes):
+        self.window_bytes += n_bytes
+
+    def window(self):
+        now = self.clock()
+        throughput = self.window_bytes / max(now - self.window_start, 1e-9)
+        self.window_start, self.window_bytes = now, 0
+        return throughput
+
+    def elapsed(self):
+        return self.clock() - self.start
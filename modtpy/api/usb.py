@@ -1,9 +1,18 @@
+import logging
 import os
-import usb
+import time
+import usb.core
+import usb.util
 import threading
 from contextlib import contextmanager
 import fasteners
 
+try:
+    # optional, for libusb hotplug events (pyusb doesn't expose them)
+    import usb1
+except ImportError:
+    usb1 = None
+
 MUTEX_PATH = os.sep.join([os.path.expanduser("~"), ".modtpy.lock"])
 
 
@@ -21,62 +30,198 @@ class Mode:
 _lock = threading.Lock()
 
 
+def scan_mode(vendor_id):
+    """ enumerates the usb bus to find the mode of the device with the given vendor id """
+    if usb.core.find(idVendor=vendor_id, idProduct=Mode.OPERATE):
+        return Mode.OPERATE
+    elif usb.core.find(idVendor=vendor_id, idProduct=Mode.DFU):
+        return Mode.DFU
+    return Mode.DISCONNECTED
+
+
+class ModeTracker:
+    """ caches the mode of a usb device for ttl seconds, so that reading it doesn't enumerate the bus every time.
+    the cache is invalidated on usb errors and reboots of the device. if libusb hotplug events are available (through
+    the optional libusb1 package), the cache is invalidated on attach and detach events instead and doesn't expire """
+
+    def __init__(self, vendor_id, ttl=1., hotplug=True):
+        self.vendor_id = vendor_id
+        self.ttl = ttl
+        self._mode = None
+        self._time = 0
+        self._lock = threading.Lock()
+        self.hotplug_active = hotplug and self._start_hotplug()
+
+    @property
+    def mode(self):
+        with self._lock:
+            if self._mode is not None and (self.hotplug_active or time.monotonic() - self._time < self.ttl):
+                return self._mode
+        mode = scan_mode(self.vendor_id)
+        with self._lock:
+            self._mode, self._time = mode, time.monotonic()
+        return mode
+
+    def invalidate(self):
+        with self._lock:
+            self._mode = None
+
+    def _on_hotplug(self, context, device, event):
+        self.invalidate()
+        # keep the callback registered
+        return False
+
+    def _start_hotplug(self):
+        if usb1 is None:
+            return False
+        try:
+            context = usb1.USBContext()
+            if not context.hasCapability(usb1.CAP_HAS_HOTPLUG):
+                context.close()
+                return False
+            context.hotplugRegisterCallback(self._on_hotplug, vendor_id=self.vendor_id,
+                                            events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED | usb1.HOTPLUG_EVENT_DEVICE_LEFT)
+        except usb1.USBError as e:
+            logging.debug("libusb hotplug unavailable: %s", e)
+            return False
+
+        def handle_events():
+            while True:
+                context.handleEvents()
+
+        thread = threading.Thread(target=handle_events, daemon=True)
+        thread.start()
+        return True
+
+
+_mode_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+class DeviceSession:
+    """ keeps one configured handle per usb device and reuses it across operations, instead of finding, configuring and
+    resetting the device for every single one. a handle is dropped on usb errors or when the device reboots and is
+    reopened on next use. only used while holding USBDevice.lock, which makes it safe to share between threads """
+
+    def __init__(self):
+        self._devices = {}
+
+    def acquire(self, vendor_id, product_id):
+        dev = self._devices.get((vendor_id, product_id))
+        if dev is None:
+            dev = usb.core.find(idVendor=vendor_id, idProduct=product_id)
+            if dev is None:
+                raise RuntimeError("Device %04x:%04x not found" % (vendor_id, product_id))
+            dev.set_configuration()
+            self._devices[(vendor_id, product_id)] = dev
+        return dev
+
+    @staticmethod
+    def release(dev):
+        # give up the claim of the interface, so that other processes can use the device between operations
+        try:
+            usb.util.release_interface(dev, 0)
+        except usb.core.USBError:
+            pass
+
+    def invalidate(self, vendor_id, product_id=None):
+        for key in list(self._devices):
+            if key[0] == vendor_id and product_id in (None, key[1]):
+                dev = self._devices.pop(key)
+                try:
+                    usb.util.dispose_resources(dev)
+                except usb.core.USBError:
+                    pass
+
+
 class USBDevice:
     dev_vendor_id = 0x000
+    session = DeviceSession()
+
+    # seconds to wait for the device in lock. within a ModT, the command channel and the exclusive users of the device
+    # take turns without waiting for the lock (see ChannelThread.paused), so that the timeout applies to other processes
+    lock_timeout = 0.5
 
     @contextmanager
-    def lock(self, timeout=0.5):
-        process_lock = fasteners.InterProcessLock(MUTEX_PATH)
-        proc_acquired = process_lock.acquire(timeout=timeout)
-        thread_acquired = _lock.acquire(timeout=timeout)
+    def lock(self, timeout=None):
+        if timeout is None:
+            timeout = self.lock_timeout
+        # the thread lock first, so that threads of this process don't compete for the file lock
+        if not _lock.acquire(timeout=timeout):
+            raise TimeoutError("Couldn't acquire lock for %s" % MUTEX_PATH)
         try:
-            if not proc_acquired or not thread_acquired:
+            process_lock = fasteners.InterProcessLock(MUTEX_PATH)
+            if not process_lock.acquire(timeout=timeout):
                 raise TimeoutError("Couldn't acquire lock for %s" % MUTEX_PATH)
-            yield
-        finally:
-            if proc_acquired:
+            try:
+                yield
+            finally:
                 process_lock.release()
-            if thread_acquired:
-                _lock.release()
+        finally:
+            _lock.release()
 
     @contextmanager
     def get_device(self, required_mode=Mode.OPERATE):
         with self.lock():
-            if self.mode != required_mode:
+            mode = self.mode
+            if mode != required_mode:
+                # the cached mode may be outdated, e.g. right after the device rebooted
+                self.mode_tracker().invalidate()
+                mode = self.mode
+            if mode != required_mode:
                 raise RuntimeError("Device is in %s but need %s" %
-                                   (Mode.to_string(self.mode), Mode.to_string(required_mode)))
+                                   (Mode.to_string(mode), Mode.to_string(required_mode)))
 
-            dev = usb.core.find(idVendor=self.dev_vendor_id, idProduct=required_mode)
+            dev = self.session.acquire(self.dev_vendor_id, required_mode)
             try:
-                dev.set_configuration()
                 yield dev
+            except usb.core.USBError:
+                # e.g. the device has been unplugged or rebooted, reconnect on next use
+                self.session.invalidate(self.dev_vendor_id, required_mode)
+                self.mode_tracker().invalidate()
+                raise
             finally:
-                if dev is not None:
-                    dev.reset()
-                del dev
+                self.session.release(dev)
+
+    def drop_device(self):
+        """ forgets the open device handles, e.g. because the device is about to reboot. call while holding the
+        device, i.e. within get_device """
+        self.session.invalidate(self.dev_vendor_id)
+        self.mode_tracker().invalidate()
+
+    @classmethod
+    def mode_tracker(cls):
+        """ the ModeTracker of this device class, shared by all instances """
+        tracker = _mode_trackers.get(cls.dev_vendor_id)
+        if tracker is None:
+            with _trackers_lock:
+                tracker = _mode_trackers.get(cls.dev_vendor_id)
+                if tracker is None:
+                    tracker = _mode_trackers[cls.dev_vendor_id] = ModeTracker(cls.dev_vendor_id)
+        return tracker
 
     @property
     def mode(self):
-        if usb.core.find(idVendor=self.dev_vendor_id, idProduct=Mode.OPERATE):
-            return Mode.OPERATE
-        elif usb.core.find(idVendor=self.dev_vendor_id, idProduct=Mode.DFU):
-            return Mode.DFU
-        return Mode.DISCONNECTED
+        return self.mode_tracker().mode
 
     @classmethod
     def _get_status(cls, device):
         raise NotImplementedError
 
     def get_status(self, device=None):
-        if self.mode is Mode.DISCONNECTED:
+        mode = self.mode
+        if mode is Mode.DISCONNECTED:
             msg = dict(status=dict(state="disconnected"))
-        elif self.mode is Mode.DFU:
+        elif mode is Mode.DFU:
             msg = dict(status=dict(state="DFU mode"))
         else:
             if device is not None:
                 msg = self._get_status(device)
             else:
-                with self.get_device(Mode.OPERATE) as dev:
-                    msg = self._get_status(dev)
+                msg = self._query_status()
 
         return msg
+
+    def _query_status(self):
+        with self.get_device(Mode.OPERATE) as dev:
+            return self._get_status(dev)
@@ -1,5 +1,10 @@
+import io
+import json
 import logging
+import mmap
+import os
 import re
+from contextlib import contextmanager
 from io import StringIO
 
 
@@ -15,6 +20,42 @@ class TqdmLogger(StringIO):
         self.logger.log(logging.INFO, self.buf)
 
 
+@contextmanager
+def gcode_buffer(gcode_file):
+    """ yields the content of gcode_file, a path or a binary file object read from its current position, as a
+    read-only memoryview. files on disk are memory-mapped and in-memory files are exposed directly, so that even large
+    gcode files are never copied into memory as a whole. views sliced from the buffer must not outlive the context """
+    if isinstance(gcode_file, (str, os.PathLike)):
+        with open(gcode_file, "rb") as f:
+            with gcode_buffer(f) as buffer:
+                yield buffer
+        return
+
+    start = gcode_file.tell()
+    if hasattr(gcode_file, "getbuffer"):
+        # e.g. io.BytesIO
+        with gcode_file.getbuffer() as view:
+            with view[start:].toreadonly() as buffer:
+                yield buffer
+        return
+
+    try:
+        fileno = gcode_file.fileno()
+        size = os.fstat(fileno).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        size = None
+    if not size:
+        # neither mappable nor an in-memory file, or an empty one which can't be mapped
+        with memoryview(gcode_file.read()) as buffer:
+            yield buffer
+        return
+
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            with view[start:] as buffer:
+                yield buffer
+
+
 class JsonRegexParser:
     def __init__(self, msg):
         self.parse(msg)
@@ -34,7 +75,8 @@ class JsonRegexParser:
         return self.get_attributes()
 
 
-class PrinterStatus(JsonRegexParser):
+class RegexPrinterStatus(JsonRegexParser):
+    """ regex based parser of status messages, only used for messages that can't be decoded as json """
     model_name = None
 
     class _Status(JsonRegexParser):
@@ -70,5 +112,74 @@ class PrinterStatus(JsonRegexParser):
                 'time': self.time.to_dict()}
 
 
+class _StatusSection:
+    __slots__ = ()
+
+    def __init__(self, values=None):
+        values = values if isinstance(values, dict) else {}
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join("%s=%r" % item for item in self.to_dict().items()))
+
+
+class PrinterState(_StatusSection):
+    __slots__ = ("state", "build_plate", "filament", "extruder_temperature", "extruder_target_temperature")
+
+
+class JobStatus(_StatusSection):
+    __slots__ = ("id", "source", "progress", "rx_progress", "current_line_number", "current_gcode_number",
+                 "file_size", "file")
+
+
+class TimeStatus(_StatusSection):
+    __slots__ = ("idle", "boot")
+
+
+class PrinterStatus:
+    """ decoded status message of the printer. to_dict returns the same layout as the former regex parser, but with
+    the json types of the values """
+    __slots__ = ("message", "model_name", "status", "job", "time")
+
+    def __init__(self, message, data):
+        self.message = message
+        self.model_name = data.get("model_name")
+        self.status = PrinterState(data.get("status"))
+        self.job = JobStatus(data.get("job"))
+        self.time = TimeStatus(data.get("time"))
+
+    def to_dict(self):
+        return dict(message=self.message, model_name=self.model_name, job=self.job.to_dict(),
+                    status=self.status.to_dict(), time=self.time.to_dict())
+
+
+_json_decoder = json.JSONDecoder()
+
+
+def decode_json(msg):
+    """ returns the json object in msg, skipping garbage before and after it, or None if there is none """
+    try:
+        data = json.loads(msg)
+    except ValueError:
+        # e.g. garbled first frames after connecting, or a checksum prefix
+        start = msg.find("{")
+        if start < 0:
+            return None
+        try:
+            data, _ = _json_decoder.raw_decode(msg, start)
+        except ValueError:
+            return None
+    return data if isinstance(data, dict) else None
+
+
 def parse_json(msg):
-    return PrinterStatus(msg)
+    """ decodes the status message msg into a PrinterStatus. falls back to the regex parser for messages that
+    aren't valid json even after skipping leading and trailing garbage """
+    data = decode_json(msg)
+    if data is None:
+        data = RegexPrinterStatus(msg).to_dict()
+    return PrinterStatus(msg, data)
@@ -5,7 +5,10 @@ from pathlib import Path
 
 from tqdm.auto import tqdm
 
-from modtpy.api.gcode_optimization import GcodeOptimizer
+from modtpy.api.gcode_cache import GcodeCache
+from modtpy.api.gcode_optimization import GcodeOptimizer, ArcWelder, BACKENDS, ALGORITHMS, write_lines
+from modtpy.api.transfer import UploadSettings
+from modtpy.api.utils import gcode_buffer
 
 try:
     import click
@@ -15,7 +18,7 @@ except ImportError as e:
 
 import logging
 
-from modtpy.api.modt import ModT, Mode
+from modtpy.api.modt import ModT, Mode, gcode_checksum
 from modtpy.cli.tools import ensure_connected, get_user_choice
 
 
@@ -34,16 +37,53 @@ def cli_root(debug):
 @cli_root.command()
 @click.option('--port', default=5000, help='Port the server should be running on.')
 @click.option('--host', default="127.0.0.1", help="The host which the server is exposed to")
-def web_server(port, host):
-    from modtpy.web import server
-    server.run(port=port, host=host)
+@click.option('--production', is_flag=True,
+              help="Serve with the multi-threaded waitress server and own the printer in a separate process.")
+@click.option('--threads', default=16, help="Number of request threads of the production server.")
+@click.option('--printer-port', default=5050, help="Local port of the printer process in production mode.")
+def web_server(port, host, production, threads, printer_port):
+    if production:
+        from modtpy.web import production as production_server
+        try:
+            production_server.run(host=host, port=port, threads=threads, printer_port=printer_port)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+    else:
+        from modtpy.web import server
+        server.run(port=port, host=host, threaded=True)
+
+
+@cli_root.command()
+@click.option('--port', default=5050, help="Local port the printer process should be listening on.")
+@click.option('--authkey', envvar="MODTPY_PRINTER_AUTHKEY",
+              help="Hex encoded key that the web workers authenticate with.")
+def printer_service(port, authkey):
+    """ own the printer for the workers of another wsgi server (e.g. gunicorn -w 4 modtpy.web:server), which are
+    started with MODTPY_PRINTER_ADDRESS=127.0.0.1:<port> and the same MODTPY_PRINTER_AUTHKEY """
+    from modtpy.web.service import AUTHKEY_ENV, serve
+    if not authkey:
+        authkey = os.urandom(16).hex()
+        print("%s=%s" % (AUTHKEY_ENV, authkey))
+    serve(("127.0.0.1", port), bytes.fromhex(authkey))
 
 
 @cli_root.command()
 @click.argument("gcode_path", type=click.Path(file_okay=True, dir_okay=False, readable=True))
+@click.option("--packets-per-write", type=click.IntRange(min=1), default=80,
+              help="Size of each bulk write in usb packets (64 bytes each).")
+@click.option("--drain-interval", type=click.IntRange(min=1), default=20,
+              help="Number of bulk writes between reading the status messages of the printer.")
+@click.option("--adaptive/--no-adaptive", default=False,
+              help="Tune the drain interval for throughput during the upload, starting from --drain-interval.")
+@click.option("--write-timeout", type=click.IntRange(min=1), default=5000, help="Timeout of each bulk write in ms.")
+@click.option("--prefetch", type=click.IntRange(min=0), default=0,
+              help="Number of bulk writes read ahead from the file in a background thread.")
 @ensure_connected(Mode.OPERATE)
-def send_gcode(gcode_path, modt):
-    modt.send_gcode(gcode_path)
+def send_gcode(gcode_path, packets_per_write, drain_interval, adaptive, write_timeout, prefetch, modt):
+    settings = UploadSettings(packets_per_write=packets_per_write, drain_interval=drain_interval,
+                              write_timeout=write_timeout, adaptive=adaptive, prefetch=prefetch)
+    # the checksum is computed while the printer reboots
+    modt.send_prepared_gcode(lambda: (gcode_path, gcode_checksum(gcode_path)), settings=settings)
     loop_print_status(modt, tqdm_progress=True)
 
 
@@ -51,18 +91,35 @@ def send_gcode(gcode_path, modt):
 @click.argument("gcode_path", type=click.Path(file_okay=True, dir_okay=False, readable=True))
 @click.argument("output_path", default=None, type=click.Path(file_okay=True, dir_okay=True, writable=True, exists=False))
 @click.option("-e", "error_threshold", type=click.FLOAT, default=0.15)
-def optimize_gcode(gcode_path, output_path, error_threshold):
+@click.option("-b", "--backend", type=click.Choice(BACKENDS), default="python",
+              help="Backend for computing merge errors, numpy is faster on long move sequences.")
+@click.option("-a", "--algorithm", type=click.Choice(ALGORITHMS), default="exact",
+              help="Merge algorithm, corridor runs in linear time but merges slightly fewer moves.")
+@click.option("-j", "--jobs", type=click.IntRange(min=1), default=1,
+              help="Number of processes optimizing the file in parallel.")
+@click.option("--arc-tolerance", type=click.FLOAT, default=None,
+              help="Replace moves along circles by G2/G3 arcs deviating at most this much (in mm) from the "
+                   "optimized path. Should be at least the error threshold. Disabled by default.")
+@click.option("--cache/--no-cache", default=True, help="Reuse previously optimized results of the same file.")
+def optimize_gcode(gcode_path, output_path, error_threshold, backend, algorithm, jobs, arc_tolerance, cache):
     assert gcode_path.endswith(".gcode"), "must provide a .gcode file but got " + Path(gcode_path).name
-    with open(gcode_path, "r") as f:
-        content = f.read()
-    optimized = GcodeOptimizer().optimize_gcode(content, error_threshold)
     if output_path is None:
         output_path = gcode_path.replace(".gcode", "_optimized.gcode")
     if os.path.isdir(output_path):
         output_path = output_path + "/" + Path(gcode_path).name
     logging.info("writing result to " + output_path)
-    with open(output_path, "w") as f:
-        f.write(optimized)
+    optimizer = GcodeOptimizer(backend=backend, algorithm=algorithm, jobs=jobs)
+    welder = ArcWelder(tolerance=arc_tolerance) if arc_tolerance is not None else None
+    if cache:
+        GcodeCache().optimize_to(gcode_path, output_path, optimizer, error_threshold, welder=welder)
+        return
+
+    # stream line by line from the memory-mapped input to the output so that memory usage stays flat for large files
+    with gcode_buffer(gcode_path) as buffer, open(output_path, "w") as out_file:
+        lines = optimizer.optimize_buffer(buffer, error_threshold)
+        if welder is not None:
+            lines = welder.weld_lines(lines)
+        write_lines(lines, out_file)
 
 
 @cli_root.command()
@@ -1,10 +1,16 @@
+import os
+
 from flask import Flask
 from modtpy.api.errors import PrinterError
 from modtpy.web.errors import handle_error
 from modtpy.web.main.controllers import main
 from modtpy.web.printer.controllers import printer
+from modtpy.web.static_assets import StaticAssets
 
-server = Flask(__name__)
+# static files are served by StaticAssets, which adds caching headers and compressed variants
+server = Flask(__name__, static_folder=None)
+assets = StaticAssets(os.path.join(os.path.dirname(__file__), "static"))
+server.add_url_rule("/static/<path:filename>", endpoint="static", view_func=assets.send)
 server.errorhandler(PrinterError)(handle_error)
 server.register_blueprint(main, url_prefix='/')
-server.register_blueprint(printer, url_prefix='/printer')
\ No newline at end of file
+server.register_blueprint(printer, url_prefix='/printer')
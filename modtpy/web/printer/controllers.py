@@ -1,61 +1,32 @@
-from io import BytesIO
+import json
 import time
 from pathlib import Path
 import traceback
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
+from werkzeug.formparser import parse_form_data
 
-from modtpy.api.gcode_optimization import GcodeOptimizer
-from modtpy.api.modt import ModT, Mode
+from modtpy.api.errors import PrinterError
+from modtpy.api.gcode_optimization import BACKENDS
+from modtpy.api.jobs import SpoolFile
+from modtpy.web.service import get_service, install_log_handler
 import logging
-from queue import LifoQueue
 
 
 printer = Blueprint('printer', __name__)
 
 
-class WebLoggingHandler(logging.Handler):
-    max_size = 25
-    queue = LifoQueue()
-
-    def emit(self, record):
-        msg = self.format(record)
-        if "GET /" not in msg and "POST /" not in msg:
-            messages = self.queue.get() if self.queue.qsize() else []
-            for line in msg.split("\n"):
-                line = line.replace("\t", "  ")
-                t = time.time()
-                messages.append(dict(time_fmt=time.strftime("%H:%M:%S"),
-                                     timestamp=t,
-                                     id=str(t) + str(hash(line))[:5],
-                                     message=line.replace("\t", "  ")))
-            self.queue.put(messages[-self.max_size:])
-
-    @classmethod
-    def get_messages(cls):
-        if cls.queue.qsize():
-            messages = cls.queue.get()
-            cls.queue.put(messages)
-            return messages
-        else:
-            return []
-
-
 level = logging.INFO
-h = WebLoggingHandler()
 root = logging.getLogger()
-root.addHandler(h)
+install_log_handler(root)
 root.setLevel(level)
 
 
-modt = ModT()
-modt.run_status_loop()
-
-
 @printer.route('/set-log-level', methods=["POST"])
 def set_log_level():
     level_str = request.args.get("level")
     loglevel = getattr(logging, level_str.upper())
     root.setLevel(loglevel)
+    get_service().set_log_level(loglevel)
 
 
 def handle_exception(function):
@@ -63,6 +34,9 @@ def handle_exception(function):
         try:
             return function(*args, **kwargs)
         except Exception as e:
+            if isinstance(e, PrinterError) and e.status_code is not None:
+                # answered with its status code by the error handler of the app, e.g. 404 for unknown jobs
+                raise
             logging.warning(f"Exception occurred while executing %s: %s", function.__name__, e)
             tb = traceback.format_exc()
             print(tb)
@@ -76,52 +50,169 @@ def handle_exception(function):
 @printer.route('/status')
 @handle_exception
 def status():
-    try:
-        mode = Mode.to_string(modt.mode)
-    except Exception as e:
-        logging.exception("unable to get mode")
-        mode = dict(error=str(e))
-    try:
-        status_dict = modt.get_status()
-    except Exception as e:
-        logging.exception("unable to get status")
-        status_dict = dict(error=str(e))
+    service = get_service()
+    # without the logs, which clients fetch incrementally from /logs or the status events
+    return jsonify(mode=service.mode(), status=service.status())
+
+
+def status_diff(old: dict, new: dict, path=()):
+    """ the entries of new that differ from old, recursing into dicts, and the key paths of the entries of old that
+    new doesn't have. removed entries are listed apart, as None is a valid value of the status """
+    diff, removed = {}, []
+    for key in old.keys() - new.keys():
+        removed.append([*path, key])
+    for key, value in new.items():
+        old_value = old.get(key)
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            value, removed_below = status_diff(old_value, value, path=(*path, key))
+            removed += removed_below
+            if value:
+                diff[key] = value
+        elif key not in old or value != old_value:
+            diff[key] = value
+    return diff, removed
+
+
+# entries of the status that aren't streamed: the raw status message changes with every poll, as it includes the
+# idle and boot times, and clients only show the decoded entries
+UNSTREAMED_KEYS = {"message"}
+
+
+# seconds between the events of a status stream at most, progress updates during uploads are published much faster
+EVENT_INTERVAL = .25
+# seconds after which an idle stream sends a comment, so that proxies don't close it
+KEEPALIVE_INTERVAL = 15
+
+
+@printer.route('/status/events')
+def status_events():
+    """ server-sent events with the changes of mode and status and the new log lines, as they are published by the
+    status loop. the first event holds the complete state, the following ones only the entries that changed """
+
+    service = get_service()
+
+    def events():
+        sent = dict(mode=None, status={})
+        last_log = log_epoch = None
+        status_time = None
+        while True:
+            latest_time, latest = service.wait_for_status(status_time, timeout=KEEPALIVE_INTERVAL)
+            if latest_time == status_time:
+                yield ": keepalive\n\n"
+                continue
+            status_time = latest_time
+            event = {}
+            mode = service.mode()
+            if mode != sent["mode"]:
+                event["mode"] = sent["mode"] = mode
+            latest = {key: value for key, value in latest.items() if key not in UNSTREAMED_KEYS}
+            diff, removed = status_diff(sent["status"], latest)
+            if diff:
+                event["status"] = diff
+            if removed:
+                event["removed"] = removed
+            sent["status"] = latest
+            logs = service.logs(last_log, log_epoch)
+            log_epoch = logs["epoch"]
+            if logs["logs"]:
+                event.update(logs)
+                last_log = logs["logs"][-1]["id"]
+            if event:
+                yield "data: %s\n\n" % json.dumps(event)
+            time.sleep(EVENT_INTERVAL)
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@printer.route('/logs')
+@handle_exception
+def logs():
+    # only the lines after the sequence number after, or the last few lines if it isn't given or belongs to the epoch
+    # of another printer process
+    after = request.args.get("after", type=int)
+    return jsonify(get_service().logs(after, request.args.get("epoch")))
 
-    logs = WebLoggingHandler.get_messages()
-    return jsonify(mode=mode, status=status_dict, logs=logs)
+
+@printer.route('/status/history')
+@handle_exception
+def status_history():
+    # only the samples after since, so that clients can poll the delta
+    since = request.args.get("since", default=float("-inf"), type=float)
+    return jsonify(get_service().status_history(since))
 
 
 @printer.route('/upload-gcode', methods=["POST"])
 @handle_exception
 def upload_gcode():
-    file = next(iter(request.files.values()))
-    should_optimize = request.values.get("optimize") == "true"
-
-    extension = Path(file.filename).suffix
-    if extension.lower() != ".gcode":
-        raise RuntimeError("only gcode extensions supported but got " + extension)
-
-    if should_optimize:
-        gcode = file.stream.read().decode("utf-8")
-        optimized = GcodeOptimizer().optimize_gcode(gcode, logger=root)
-        file.stream = BytesIO()
-        file.stream.write(optimized.encode())
-        file.stream.seek(0)
-
-    modt.send_gcode(file.stream, logger=root)
-    modt.press_button()
-    return status()
+    # the uploaded file is streamed straight into a spool file of the job queue, which computes its size and checksum
+    # on the fly, instead of being buffered by the default form parser and copied afterwards
+    service = get_service()
+    spool_dir = service.spool_dir()
+    spools = []
+
+    def spool_factory(**kwargs):
+        spools.append(SpoolFile.create(spool_dir))
+        return spools[-1]
+
+    try:
+        _, form, files = parse_form_data(request.environ, stream_factory=spool_factory)
+        file = files.get("file")
+        if file is None:
+            raise PrinterError("no file uploaded", status_code=400)
+        # optimize may be "true" for the default backend or the name of an optimizer backend, e.g. "numpy"
+        optimize = form.get("optimize")
+        should_optimize = optimize == "true" or optimize in BACKENDS
+
+        extension = Path(file.filename).suffix
+        if extension.lower() != ".gcode":
+            raise RuntimeError("only gcode extensions supported but got " + extension)
+
+        backend = (optimize if optimize in BACKENDS else "python") if should_optimize else None
+        # the job is only spooled here, optimizing and sending it is left to the worker of the job queue
+        spool = file.stream
+        spool.close()
+        job = service.submit_job(spool.job_id, spool.path, file.filename, checksum=spool.adler32,
+                                 options=dict(optimize=backend))
+    except BaseException:
+        for spool in spools:
+            spool.discard()
+        raise
+    for spool in spools:
+        if spool.job_id != job["id"]:
+            spool.discard()
+    response = jsonify(job=job)
+    response.status_code = 202
+    return response
+
+
+@printer.route('/jobs')
+@handle_exception
+def list_jobs():
+    return jsonify(jobs=get_service().jobs())
+
+
+@printer.route('/jobs/<job_id>')
+@handle_exception
+def get_job(job_id):
+    return jsonify(job=get_service().job(job_id))
+
+
+@printer.route('/jobs/<job_id>/cancel', methods=["POST"])
+@handle_exception
+def cancel_job(job_id):
+    return jsonify(job=get_service().cancel_job(job_id))
 
 
 @printer.route('/load-filament')
 @handle_exception
 def load_filament():
-    modt.load_filament()
+    get_service().load_filament()
     return status()
 
 
 @printer.route('/unload-filament')
 @handle_exception
 def unload_filament():
-    modt.unload_filament()
+    get_service().unload_filament()
     return status()
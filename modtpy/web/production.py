@@ -0,0 +1,56 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from modtpy.web import service
+
+try:
+    import waitress
+except ImportError:
+    # optional, see the production extra in setup.py
+    waitress = None
+
+
+def wait_for_printer(address, process, timeout=30):
+    """ waits until the printer process accepts connections at address """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=1).close()
+            return
+        except OSError:
+            if not process.is_alive():
+                raise RuntimeError("printer process exited with code %s" % process.exitcode)
+            if time.time() > deadline:
+                raise TimeoutError("printer process didn't start listening at %s:%i" % address)
+            time.sleep(.1)
+
+
+def run(host="127.0.0.1", port=5000, threads=16, printer_port=service.DEFAULT_PORT):
+    """ serves the web ui with the multi-threaded waitress server. the printer is owned by a separate printer process
+    (see service.serve), whose PrinterService the request threads call over a local manager connection. every open
+    status stream holds one of the threads """
+    if waitress is None:
+        raise RuntimeError("the production server requires waitress, install it with pip install modtpy[production]")
+
+    address = ("127.0.0.1", printer_port)
+    authkey = os.urandom(16)
+    # not a daemon, as the gcode optimizer may start worker processes of its own
+    printer = multiprocessing.Process(target=service.serve, args=(address, authkey), name="modtpy-printer")
+    printer.start()
+    try:
+        os.environ[service.ADDRESS_ENV] = "%s:%i" % address
+        os.environ[service.AUTHKEY_ENV] = authkey.hex()
+        wait_for_printer(address, printer)
+
+        from modtpy.web import assets, server
+        # brotli at its highest quality takes a few seconds for the fonts, requests meanwhile compress on demand
+        threading.Thread(target=assets.preload, daemon=True).start()
+        logging.info("serving web ui at http://%s:%i with %i threads", host, port, threads)
+        waitress.serve(server, host=host, port=port, threads=threads)
+    finally:
+        printer.terminate()
+        printer.join()
@@ -0,0 +1,197 @@
+import collections
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from multiprocessing.managers import BaseManager
+
+from modtpy.api.gcode_cache import GcodeCache
+from modtpy.api.gcode_optimization import GcodeOptimizer
+from modtpy.api.jobs import JobQueue, PrintJob, SPOOL_DIR
+from modtpy.api.modt import ModT, Mode
+
+# "host:port" of the printer process that web workers connect to (see serve and get_service), and the hex encoded
+# key that authenticates them. without an address, every process owns the printer itself
+ADDRESS_ENV = "MODTPY_PRINTER_ADDRESS"
+AUTHKEY_ENV = "MODTPY_PRINTER_AUTHKEY"
+DEFAULT_PORT = 5050
+
+
+class WebLoggingHandler(logging.Handler):
+    """ keeps the last max_size log lines for the web ui in a ring buffer. every line gets a sequence number, so that
+    clients can fetch only the lines after the last one they have (see get_messages). appending is O(1) and never
+    touches the older lines, which matters for the many progress lines logged during uploads. fetching only visits
+    the lines that are returned """
+    max_size = 500
+    # number of lines sent to clients that don't have any yet
+    initial_size = 25
+    lines = collections.deque(maxlen=max_size)
+    sequence = itertools.count(1)
+    # identifies the sequence numbers of this process, which start at 1 again in a restarted one
+    epoch = uuid.uuid4().hex[:12]
+    # shared by all handlers like the lines, as iterating a deque fails if another thread appends meanwhile
+    lines_lock = threading.Lock()
+
+    def emit(self, record):
+        msg = self.format(record)
+        if "GET /" not in msg and "POST /" not in msg:
+            t = time.time()
+            time_fmt = time.strftime("%H:%M:%S", time.localtime(t))
+            with self.lines_lock:
+                for line in msg.split("\n"):
+                    self.lines.append(dict(id=next(self.sequence), time_fmt=time_fmt, timestamp=t,
+                                           message=line.replace("\t", "  ")))
+
+    @classmethod
+    def get_messages(cls, after=None, epoch=None):
+        """ the lines with a sequence number greater than after, or the last initial_size lines if after is None.
+        after is ignored if it is given with an epoch other than the one of this process """
+        if epoch is not None and epoch != cls.epoch:
+            after = None
+        lines = []
+        with cls.lines_lock:
+            # from the newest line back, so that the older lines are never visited
+            for line in reversed(cls.lines):
+                if len(lines) == cls.initial_size if after is None else line["id"] <= after:
+                    break
+                lines.append(line)
+        lines.reverse()
+        return lines
+
+
+def install_log_handler(logger=None):
+    """ adds a WebLoggingHandler to logger (the root logger by default) unless it has one already, as all handlers
+    share the same buffer and would store every line once per handler """
+    logger = logger if logger is not None else logging.getLogger()
+    if not any(isinstance(handler, WebLoggingHandler) for handler in logger.handlers):
+        logger.addHandler(WebLoggingHandler())
+
+
+class PrinterService:
+    """ the printer with its status loop and job queue, behind methods that take and return plain data. the web
+    controllers only use these methods, so that the service can live in the web process or in a separate printer
+    process that web workers call through a PrinterManager """
+
+    def __init__(self, spool_dir=SPOOL_DIR):
+        self.modt = ModT()
+        self.gcode_cache = GcodeCache()
+        self.job_queue = JobQueue(self.modt, prepare=self._prepare_job, spool_dir=spool_dir,
+                                  logger=logging.getLogger())
+        self.modt.run_status_loop()
+
+    def _prepare_job(self, job: PrintJob):
+        # runs while the printer reboots
+        backend = job.options.get("optimize")
+        if backend is not None:
+            # previously optimized files are taken from the cache, including their checksum
+            # cancelling the job aborts the optimization
+            entry = self.gcode_cache.optimize(job.path, GcodeOptimizer(backend=backend), logger=logging.getLogger(),
+                                              wrap_lines=job.watch)
+            return entry.path, entry.adler32
+        # checksummed while it was spooled
+        return job.path, job.checksum
+
+    def spool_dir(self):
+        return self.job_queue.spool_dir
+
+    def set_log_level(self, level):
+        logging.getLogger().setLevel(level)
+
+    def mode(self):
+        try:
+            return Mode.to_string(self.modt.mode)
+        except Exception as e:
+            logging.exception("unable to get mode")
+            return dict(error=str(e))
+
+    def status(self):
+        try:
+            return self.modt.get_status()
+        except Exception as e:
+            logging.exception("unable to get status")
+            return dict(error=str(e))
+
+    def wait_for_status(self, since=None, timeout=None):
+        """ waits until a status newer than the one published at time since is available and returns the
+        (time, status) of the latest one, which is still the one of since if the timeout passed """
+        snapshot = self.modt.status_snapshot
+        if snapshot.time == since:
+            snapshot = self.modt.wait_for_status(snapshot, timeout=timeout)
+        return snapshot.time, snapshot.status
+
+    def status_history(self, since):
+        return self.modt.status_history.since(since)
+
+    def logs(self, after=None, epoch=None):
+        """ the log lines after the sequence number after of epoch (see WebLoggingHandler.get_messages), and the
+        epoch of their sequence numbers """
+        return dict(epoch=WebLoggingHandler.epoch, logs=WebLoggingHandler.get_messages(after, epoch))
+
+    def submit_job(self, job_id, path, filename, checksum=None, options=None):
+        return self.job_queue.submit_spooled(job_id, path, filename, checksum=checksum, **(options or {})).to_dict()
+
+    def jobs(self):
+        return [job.to_dict() for job in self.job_queue.jobs()]
+
+    def job(self, job_id):
+        return self.job_queue.get(job_id).to_dict()
+
+    def cancel_job(self, job_id):
+        return self.job_queue.cancel(job_id).to_dict()
+
+    def load_filament(self):
+        self.modt.load_filament()
+
+    def unload_filament(self):
+        self.modt.unload_filament()
+
+
+class PrinterManager(BaseManager):
+    pass
+
+
+PrinterManager.register("printer")
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def serve(address=("127.0.0.1", DEFAULT_PORT), authkey=None):
+    """ runs a PrinterService in this process and serves it to the web workers at address. never returns """
+    # the log messages of the printer are shown in the web ui, see PrinterService.logs
+    install_log_handler()
+    service = PrinterService()
+
+    class ServiceManager(PrinterManager):
+        pass
+
+    ServiceManager.register("printer", callable=lambda: service)
+    logging.info("serving printer at %s:%i", *address)
+    ServiceManager(address=address, authkey=authkey).get_server().serve_forever()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """ the PrinterService of this process, created on first use. if ADDRESS_ENV is set, a proxy of the service of the
+    printer process at that address is returned instead, whose methods are called through the manager connection """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                address = os.environ.get(ADDRESS_ENV)
+                if address:
+                    authkey = os.environ.get(AUTHKEY_ENV)
+                    authkey = bytes.fromhex(authkey) if authkey else None
+                    manager = PrinterManager(address=parse_address(address), authkey=authkey)
+                    manager.connect()
+                    _service = manager.printer()
+                else:
+                    _service = PrinterService()
+    return _service
@@ -31,24 +31,39 @@ const getStatus = () => {
     .done(payload => {
       setMode(payload.mode);
       setStatus(payload.status);
-      setLogs(payload.logs);
     })
     .fail(payload => {
       handleError(payload.responseJSON);
     });
 };
 
+// sequence number of the last log line shown, the server only sends the lines after it. the numbers start again in a
+// restarted printer process, whose lines come with another epoch
+let lastLogId = null;
+let logEpoch = null;
 
-document.logged_messages = {};
-
+const getLogs = () => {
+  $.getJSON({
+    url: "/printer/logs",
+    data: lastLogId === null ? {} : {after: lastLogId, epoch: logEpoch}
+  }).done(payload => {
+    if (payload.logs !== undefined) {
+      setLogs(payload.logs, payload.epoch);
+    }
+  });
+};
 
-const setLogs = logs => {
+const setLogs = (logs, epoch) => {
+  if (epoch !== logEpoch) {
+    lastLogId = null;
+    logEpoch = epoch;
+  }
   let logs_div = $(".logs")[0];
   let last_el = undefined;
   logs.forEach(log => {
-    if (document.logged_messages[log.id] === undefined){
+    if (lastLogId === null || log.id > lastLogId){
       let el = document.createElement("p");
-      document.logged_messages[log.id] = 1
+      lastLogId = log.id;
       el.innerHTML = document.ansispan(log.message);
       logs_div.appendChild(el);
       last_el = el;
@@ -134,7 +149,70 @@ const setMode = mode => {
 
 const pollStatus = () => {
   getStatus();
-  setInterval(getStatus, 2000);
+  getLogs();
+  setInterval(() => {
+    getStatus();
+    getLogs();
+  }, 2000);
+};
+
+// merges a diff from /printer/status/events into state, removed entries are listed apart (see applyRemoved)
+const applyDiff = (state, diff) => {
+  Object.keys(diff).forEach(key => {
+    const value = diff[key];
+    if (value !== null && typeof value === "object" && !Array.isArray(value) &&
+        typeof state[key] === "object" && state[key] !== null) {
+      applyDiff(state[key], value);
+    } else {
+      state[key] = value;
+    }
+  });
+  return state;
+};
+
+// removes the entries at the key paths of removed, e.g. [["job", "file"]]
+const applyRemoved = (state, removed) => {
+  removed.forEach(path => {
+    const parent = path.slice(0, -1).reduce((entry, key) => entry == null ? undefined : entry[key], state);
+    if (parent != null) {
+      delete parent[path[path.length - 1]];
+    }
+  });
+  return state;
+};
+
+// receives status changes pushed by the server, falls back to polling if the event stream isn't available
+const subscribeStatus = () => {
+  if (window.EventSource === undefined) {
+    pollStatus();
+    return;
+  }
+  let status = {};
+  let connected = false;
+  const source = new EventSource("/printer/status/events");
+  source.onmessage = event => {
+    connected = true;
+    const payload = JSON.parse(event.data);
+    if (payload.mode !== undefined) {
+      setMode(payload.mode);
+    }
+    if (payload.status !== undefined || payload.removed !== undefined) {
+      setStatus(applyRemoved(applyDiff(status, payload.status || {}), payload.removed || []));
+    }
+    if (payload.logs !== undefined) {
+      setLogs(payload.logs, payload.epoch);
+    }
+  };
+  source.onerror = () => {
+    // the browser reconnects by itself after a stream that worked, but not one that never opened
+    if (!connected) {
+      source.close();
+      pollStatus();
+    } else {
+      // the first event after reconnecting holds the complete state again
+      status = {};
+    }
+  };
 };
 
 
@@ -173,7 +251,8 @@ const uploadFile = (file, shouldOptimize, onSuccess) => {
       processData: false,
 
       success: function(response){
-        $(".modtpy-status").text("Upload complete");
+        $(".modtpy-status").text("Upload queued");
+        watchJob(response.job.id);
         if (onSuccess !== undefined){
           onSuccess(response);
         }
@@ -192,6 +271,35 @@ const uploadFile = (file, shouldOptimize, onSuccess) => {
   });
 }
 
+// shows the stage of a print job until it is finished
+const watchJob = jobId => {
+  const finished = ["done", "failed", "cancelled"];
+  const timer = setInterval(() => {
+    $.getJSON({
+      url: "/printer/jobs/" + jobId
+    }).done(payload => {
+      if (payload.job === undefined) {
+        clearInterval(timer);
+        return;
+      }
+      const job = payload.job;
+      let text = job.filename + ": " + job.state;
+      if (job.state === "uploading") {
+        text += " " + job.progress + "%";
+        if (job.kb_per_s !== null) {
+          text += " (" + job.kb_per_s.toFixed(1) + " KB/s)";
+        }
+      } else if (job.error) {
+        text += " (" + job.error + ")";
+      }
+      $("#file-description").text(text);
+      if (finished.includes(job.state)) {
+        clearInterval(timer);
+      }
+    }).fail(() => clearInterval(timer));
+  }, 1000);
+};
+
 const chooseFile = () => {
   let chooseBtn = $("#gcode_btn_file_choose")[0];
   let uploadBtn = $("#btn-start-print")[0];
@@ -226,7 +334,7 @@ const pressButton = () => {
 }
 
 $(() => {
-  pollStatus();
+  subscribeStatus();
   $("#btn-load")[0].onclick = loadFilament;
   $("#btn-unload")[0].onclick = unloadFilament;
   $("#btn-gcode")[0].onclick = chooseFile;
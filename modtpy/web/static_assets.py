@@ -0,0 +1,75 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Response, abort, request
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    # optional, see the production extra in setup.py. without it, assets are only precompressed with gzip
+    brotli = None
+
+# fonts such as woff2 are compressed already
+COMPRESSIBLE = {".css", ".js", ".svg", ".ttf", ".eot", ".html", ".json", ".txt"}
+MAX_AGE = 24 * 3600
+
+
+class Asset:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        self.mtime = os.stat(path).st_mtime
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.etag = hashlib.sha1(data).hexdigest()
+        # content encoding -> body, from the most to the least preferred encoding
+        self.variants = {}
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE:
+            if brotli is not None:
+                self.variants["br"] = brotli.compress(data)
+            self.variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+        self.variants["identity"] = data
+
+
+class StaticAssets:
+    """ serves the files in directory with caching headers. each file is read and compressed once, with brotli (if
+    installed) and gzip, and the variant accepted by the client is sent from memory. files that changed on disk are
+    reloaded, so that the assets can be edited while the server runs """
+
+    def __init__(self, directory, max_age=MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        self._assets = {}
+
+    def preload(self):
+        """ compresses all assets up front instead of on their first request """
+        for parent, _, names in os.walk(self.directory):
+            for name in names:
+                self.get(os.path.relpath(os.path.join(parent, name), self.directory).replace(os.sep, "/"))
+
+    def get(self, filename) -> Asset:
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        asset = self._assets.get(path)
+        if asset is None or asset.mtime != os.stat(path).st_mtime:
+            # concurrent requests may load the same asset twice, which is cheaper than having them wait on each other
+            asset = self._assets[path] = Asset(path)
+        return asset
+
+    def send(self, filename):
+        asset = self.get(filename)
+        if asset is None:
+            abort(404)
+        encoding = next(encoding for encoding in asset.variants
+                        if encoding == "identity" or request.accept_encodings[encoding])
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.set_etag(asset.etag if encoding == "identity" else "%s-%s" % (asset.etag, encoding))
+        return response.make_conditional(request)
@@ -56,6 +56,11 @@ setup(
         'flask',  # for web-server
         'fasteners'  # for file-based multi-process mutex (concurrent USB access)
     ],
+    extras_require={
+        'numpy': ['numpy'],  # for the vectorized gcode optimizer backend
+        'hotplug': ['libusb1'],  # for detecting attach/detach of the printer without polling the usb bus
+        'production': ['waitress', 'brotli'],  # for web-server --production and brotli compressed static files
+    },
     entry_points={
         'console_scripts': ['modtpy=modtpy.cli:cli_root'],
     }
@@ -1,6 +1,8 @@
 from modtpy.api.modt import ModT, Mode
 from modtpy.api.errors import PrinterError
+import array
 import logging
+import time
 from contextlib import contextmanager
 
 
@@ -74,3 +76,86 @@ class VirtualModt(ModT):
         return self.__class__.current_mode
 
 
+def read_into(size_or_buffer, data):
+    """ returns data like pyusb's Device.read: copied into size_or_buffer if it is an array, otherwise as an array
+    of at most size_or_buffer bytes """
+    if isinstance(size_or_buffer, array.array):
+        n_read = min(len(data), len(size_or_buffer))
+        size_or_buffer[:n_read] = array.array("B", data[:n_read])
+        return n_read
+    return array.array("B", data[:size_or_buffer])
+
+
+class RecordingUSB:
+    """ records everything written to it and answers every read with an empty message """
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, endpoint, data, timeout=None):
+        self.writes.append((endpoint, data.encode() if isinstance(data, str) else bytes(data)))
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        return read_into(size_or_buffer, b"{}")
+
+
+class RecordingModt(VirtualModt):
+    """ virtual mod-t that records all usb writes in self.usb and reboots in reboot_time seconds """
+
+    def __init__(self, usb=None):
+        super().__init__()
+        self.usb = usb if usb is not None else RecordingUSB()
+
+    @contextmanager
+    def get_device(self, required_mode=Mode.OPERATE):
+        with self.lock():
+            yield self.usb
+
+    reboot_time = 0
+
+    def _reset(self, wait_for_reboot=False):
+        with self.exclusive_device() as dev:
+            self._send_command(dev, 'Reset_printer')
+        if wait_for_reboot:
+            time.sleep(self.reboot_time)
+
+    def uploaded(self, endpoint):
+        """ returns the data written to endpoint after the file_push header """
+        writes = [data for ep, data in self.usb.writes if ep == endpoint]
+        header = next(i for i, data in enumerate(writes) if b'"file_push"' in data)
+        return writes[header], b"".join(writes[header + 1:])
+
+
+class SimulatedUSB(RecordingUSB):
+    """ rough timing model of an upload to the mod-t, for benchmarking transfer settings without a printer.
+
+    every write costs a fixed overhead plus its size divided by the bandwidth, every read costs read_latency. while
+    receiving a file, the printer queues a status message every status_every bytes. once more than queue_limit
+    messages are waiting to be read, it stalls and every write additionally costs stall_penalty """
+
+    def __init__(self, bandwidth=1024 ** 2, write_overhead=0.0005, read_latency=0.002, status_every=16 * 1024,
+                 queue_limit=4, stall_penalty=0.01):
+        super().__init__()
+        self.bandwidth = bandwidth
+        self.write_overhead = write_overhead
+        self.read_latency = read_latency
+        self.status_every = status_every
+        self.queue_limit = queue_limit
+        self.stall_penalty = stall_penalty
+        self.received = 0
+        self.drained = 0
+
+    def write(self, endpoint, data, timeout=None):
+        n_bytes = super().write(endpoint, data, timeout)
+        delay = self.write_overhead + n_bytes / self.bandwidth
+        if (self.received - self.drained) // self.status_every > self.queue_limit:
+            delay += self.stall_penalty
+        self.received += n_bytes
+        time.sleep(delay)
+        return n_bytes
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        time.sleep(self.read_latency)
+        self.drained = self.received
+        return super().read(endpoint, size_or_buffer, timeout)
@@ -0,0 +1,79 @@
+import io
+import os
+import tempfile
+import unittest
+
+from modtpy.api.gcode_cache import GcodeCache
+from modtpy.api.gcode_optimization import GcodeOptimizer
+from modtpy.api.modt import adler32_checksum
+from testing.gcode_optimization_tests import synthetic_gcode
+
+
+class GcodeCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = GcodeCache(directory=self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_entry_matches_optimizer(self):
+        gcode = synthetic_gcode()
+        entry = self.cache.optimize(io.BytesIO(gcode.encode()), GcodeOptimizer())
+        with open(entry.path, "rb") as f:
+            optimized = f.read()
+        assert optimized == GcodeOptimizer().optimize_gcode(gcode).encode()
+        assert entry.size == len(optimized)
+        assert entry.adler32 == adler32_checksum(optimized)
+
+    def test_hit_skips_optimization(self):
+        gcode = io.BytesIO(synthetic_gcode().encode())
+        first = self.cache.optimize(gcode, GcodeOptimizer())
+        gcode.seek(0)
+
+        class FailingOptimizer(GcodeOptimizer):
+            def optimize_lines(self, *args, **kwargs):
+                raise AssertionError("should have been cached")
+
+        second = self.cache.optimize(gcode, FailingOptimizer())
+        assert (first.path, first.size, first.adler32) == (second.path, second.size, second.adler32)
+
+        # a different threshold or algorithm is a different entry
+        gcode.seek(0)
+        assert self.cache.optimize(gcode, GcodeOptimizer(), error_threshold=0.3).path != first.path
+        gcode.seek(0)
+        assert self.cache.optimize(gcode, GcodeOptimizer(algorithm="corridor")).path != first.path
+
+    def test_welder_settings_in_key(self):
+        from modtpy.api.gcode_optimization import ArcWelder
+        keys = {GcodeCache.key("hash", 0.15, GcodeOptimizer(), welder) for welder in
+                (ArcWelder(), ArcWelder(min_segments=50), ArcWelder(max_segments=20), ArcWelder(tolerance=0.1))}
+        assert len(keys) == 4
+
+    def test_path_matches_file_object(self):
+        gcode = synthetic_gcode().encode()
+        with tempfile.TemporaryDirectory() as input_dir:
+            path = os.path.join(input_dir, "input.gcode")
+            with open(path, "wb") as f:
+                f.write(gcode)
+            from_path = self.cache.optimize(path, GcodeOptimizer())
+        assert self.cache.optimize(io.BytesIO(gcode), GcodeOptimizer()).path == from_path.path
+
+    def test_lru_eviction(self):
+        entries = [self.cache.optimize(io.BytesIO(synthetic_gcode(n_layers=i).encode()), GcodeOptimizer())
+                   for i in (1, 2, 3)]
+        # make the second entry the least recently used one
+        os.utime(entries[1].path, (0, 0))
+        self.cache.max_size = entries[0].size + entries[2].size
+        self.cache.evict()
+        assert [os.path.exists(e.path) for e in entries] == [True, False, True]
+
+    def test_new_entry_larger_than_cache(self):
+        self.cache.max_size = 10
+        old = self.cache.optimize(io.BytesIO(synthetic_gcode(n_layers=1).encode()), GcodeOptimizer())
+        new = self.cache.optimize(io.BytesIO(synthetic_gcode(n_layers=2).encode()), GcodeOptimizer())
+        assert os.path.exists(new.path) and not os.path.exists(old.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import cProfile
+import math
+import mmap
+import os
+import pstats
+import random
+import tempfile
+import time
+import logging
+import tracemalloc
+
+import click
+
+from modtpy.api import gcode_optimization
+from modtpy.api.gcode_optimization import GcodeOptimizer
+from modtpy.api.gcode_tokenizer import tokenize, tokenize_buffer
+
+
+def synthetic_segments(n_segments, run_length=1000, noise=0.05, seed=0):
+    """ yields lines of n_segments tiny extrusion moves, grouped into slightly noisy straight runs of run_length moves.
+    long runs are the worst case for the exact algorithm, since every run becomes a single sequence """
+    rand = random.Random(seed)
+    yield "G1 Z0.2 F1200\n"
+    yield "G1 X0 Y0\n"
+    x = y = e = 0.
+    direction = 0.
+    for i in range(n_segments):
+        if i % run_length == 0:
+            direction = rand.uniform(0, 2 * math.pi)
+        x += math.cos(direction) * 0.05
+        y += math.sin(direction) * 0.05
+        e += 0.002
+        yield "G1 X%.4f Y%.4f E%.5f\n" % (x + rand.uniform(-noise, noise), y + rand.uniform(-noise, noise), e)
+
+
+def run(optimizer, path, error_threshold):
+    with open(path) as in_file, open(os.devnull, "w") as out_file:
+        start = time.perf_counter()
+        optimizer.optimize_file(in_file, out_file, error_threshold)
+        return time.perf_counter() - start
+
+
+@click.group()
+def cli():
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+@cli.command()
+@click.option("-n", "--sizes", default="10000,100000,1000000", help="comma separated numbers of segments")
+@click.option("-r", "--run-length", default=1000, help="number of segments per straight run")
+@click.option("-e", "error_threshold", type=click.FLOAT, default=0.15)
+@click.option("--exact-limit", default=100000, help="skip the (quadratic) exact algorithm above this size")
+def scaling(sizes, run_length, error_threshold, exact_limit):
+    """ time of each algorithm and backend over the number of segments """
+    configurations = [("corridor", "python")]
+    configurations += [("exact", "python")] + ([("exact", "numpy")] if gcode_optimization.np is not None else [])
+
+    print("%10s %10s %8s %10s %14s" % ("segments", "algorithm", "backend", "seconds", "segments/s"))
+    for n_segments in map(int, sizes.split(",")):
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.writelines(synthetic_segments(n_segments, run_length=run_length))
+        try:
+            for algorithm, backend in configurations:
+                if algorithm == "exact" and n_segments > exact_limit:
+                    continue
+                seconds = run(GcodeOptimizer(backend=backend, algorithm=algorithm), f.name, error_threshold)
+                print("%10i %10s %8s %10.2f %14.0f" % (n_segments, algorithm, backend, seconds, n_segments / seconds))
+        finally:
+            os.remove(f.name)
+
+
+@cli.command()
+@click.argument("gcode_path", required=False, type=click.Path(dir_okay=False, exists=True))
+@click.option("-e", "error_threshold", type=click.FLOAT, default=0.15)
+@click.option("-a", "--algorithm", default="exact")
+def reference(gcode_path, error_threshold, algorithm):
+    """ wall time, peak memory and calls per line of the python backend on a reference file.
+    the call counts of object constructors and copies are a proxy for the number of allocations per line """
+    synthetic = gcode_path is None
+    if synthetic:
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+            f.writelines(synthetic_segments(100000, run_length=20))
+        gcode_path = f.name
+    try:
+        with open(gcode_path) as f:
+            n_lines = sum(1 for _ in f)
+
+        seconds = min(run(GcodeOptimizer(algorithm=algorithm), gcode_path, error_threshold) for _ in range(3))
+
+        tracemalloc.start()
+        run(GcodeOptimizer(algorithm=algorithm), gcode_path, error_threshold)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        profile = cProfile.Profile()
+        profile.runcall(run, GcodeOptimizer(algorithm=algorithm), gcode_path, error_threshold)
+    finally:
+        if synthetic:
+            os.remove(gcode_path)
+    calls = sorted(((stat[1], "%s:%s" % (func[0].split(os.sep)[-1], func[2]))
+                    for func, stat in pstats.Stats(profile).stats.items()), reverse=True)
+
+    print("%i lines, %.2f s, %.1f us/line, peak memory %.1f KiB" % (n_lines, seconds, seconds / n_lines * 1e6,
+                                                                   peak / 1024))
+    print("calls per line:")
+    for n_calls, name in calls[:12]:
+        print("%10.2f  %s" % (n_calls / n_lines, name))
+
+
+@cli.command()
+@click.option("-n", "--n-lines", default=1000000, help="number of synthetic lines")
+def tokenizer(n_lines):
+    """ tokenizer throughput in lines/second for str lines, bytes lines and an mmap buffer """
+    with tempfile.NamedTemporaryFile("w", suffix=".gcode", delete=False) as f:
+        f.writelines(synthetic_segments(n_lines, run_length=20))
+    try:
+        def tokenize_str():
+            with open(f.name) as text:
+                for _ in tokenize(text):
+                    pass
+
+        def tokenize_bytes():
+            with open(f.name, "rb") as binary:
+                for _ in tokenize(binary):
+                    pass
+
+        def tokenize_mmap():
+            with open(f.name, "rb") as binary, mmap.mmap(binary.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for _ in tokenize_buffer(buffer):
+                    pass
+
+        print("%8s %10s %14s" % ("input", "seconds", "lines/s"))
+        for name, func in (("str", tokenize_str), ("bytes", tokenize_bytes), ("mmap", tokenize_mmap)):
+            start = time.perf_counter()
+            func()
+            seconds = time.perf_counter() - start
+            print("%8s %10.2f %14.0f" % (name, seconds, n_lines / seconds))
+    finally:
+        os.remove(f.name)
+
+
+if __name__ == "__main__":
+    cli()
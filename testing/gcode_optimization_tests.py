@@ -0,0 +1,174 @@
+import io
+import math
+import random
+import unittest
+
+from modtpy.api import gcode_optimization
+from modtpy.api.gcode_optimization import GcodeOptimizer, ArcWelder, Vec3
+
+
+def synthetic_gcode(n_layers=3, segments=100):
+    """ a few layers of finely segmented circles and straight lines, as produced by slicers for curved perimeters """
+    lines = ["; synthetic test gcode", "G90", "M82", "G92 E0", "G1 Z0.2 F1200"]
+    e = 0.
+    for layer in range(n_layers):
+        z = 0.2 + layer * 0.2
+        lines.append(";LAYER:%i" % layer)
+        lines.append("G0 F6000 X50.000 Y50.000 Z%.3f" % z)
+        for i in range(segments + 1):
+            a = 2 * math.pi * i / segments
+            e += 0.01
+            lines.append("G1 F1800 X%.3f Y%.3f E%.5f" % (50 + 20 * math.cos(a), 50 + 20 * math.sin(a), e))
+        for i in range(segments):
+            e += 0.01
+            lines.append("G1 X%.3f Y%.3f E%.5f ; infill" % (50 + i * 0.1, 50 + 0.01 * (i % 3), e))
+        lines.append("G1 E%.5f F2400" % (e - 1))
+        lines.append("G92 E0")
+        e = 0.
+        lines.append("")
+    lines.append("M104 S0")
+    return "\n".join(lines)
+
+
+def noisy_line_gcode(n_moves=2000, noise=0.05, seed=0):
+    """ long runs of tiny, almost collinear extrusion moves, which produce very long sequences """
+    rand = random.Random(seed)
+    lines = ["G1 Z0.2 F1200", "G1 X0 Y0"]
+    for i in range(n_moves):
+        lines.append("G1 X%.4f Y%.4f E%.4f" % (i * 0.05, math.sin(i / 200) * 10 + rand.uniform(-noise, noise), i * 0.01))
+    return "\n".join(lines)
+
+
+def move_positions(gcode):
+    """ the XY position after each G0/G1 move """
+    x = y = 0.
+    positions = []
+    for line in gcode.split("\n"):
+        if line[:3] in ("G0 ", "G1 "):
+            for word in line.split(";")[0].split():
+                if word[0] == "X":
+                    x = float(word[1:])
+                elif word[0] == "Y":
+                    y = float(word[1:])
+            positions.append((x, y))
+    return positions
+
+
+class Vec3Tests(unittest.TestCase):
+    def test_math(self):
+        a, b = Vec3(1., 2., 3.), Vec3(4., 6., 8.)
+        assert b - a == Vec3(3., 4., 5.)
+        assert a + 1 == Vec3(2., 3., 4.)
+        assert a * 2 == 2 * a == Vec3(2., 4., 6.)
+        assert a ** 3 == Vec3(1., 8., 27.)
+        assert Vec3(1., 0., 0.).cross(Vec3(0., 1., 0.)) == Vec3(0., 0., 1.)
+        assert Vec3(3., 4., 0.).mag() == 5.
+        assert str(a) == "Vec3(1.0000, 2.0000, 3.0000)"
+
+    def test_immutable(self):
+        a = Vec3(1., 2., 3.)
+        with self.assertRaises(AttributeError):
+            a.x = 0.
+        assert a.copy() is a
+
+
+class GcodeOptimizerTests(unittest.TestCase):
+    def test_reduces_line_count(self):
+        gcode = synthetic_gcode()
+        optimized = GcodeOptimizer().optimize_gcode(gcode)
+        assert 0 < len(optimized.split("\n")) < len(gcode.split("\n")) / 2
+
+    def test_optimize_lines_matches_optimize_gcode(self):
+        gcode = synthetic_gcode()
+        expected = GcodeOptimizer().optimize_gcode(gcode)
+        streamed = list(GcodeOptimizer().optimize_lines(io.StringIO(gcode)))
+        assert streamed == expected.split("\n")
+
+    def test_optimize_file(self):
+        gcode = synthetic_gcode()
+        out_file = io.StringIO()
+        GcodeOptimizer().optimize_file(io.StringIO(gcode), out_file)
+        assert out_file.getvalue() == GcodeOptimizer().optimize_gcode(gcode)
+
+    @unittest.skipIf(gcode_optimization.np is None, "numpy not installed")
+    def test_numpy_backend_identical(self):
+        gcode = synthetic_gcode(n_layers=5, segments=300)
+        for error_threshold in (0.01, 0.15, 1.):
+            expected = GcodeOptimizer().optimize_gcode(gcode, error_threshold)
+            assert GcodeOptimizer(backend="numpy").optimize_gcode(gcode, error_threshold) == expected
+
+    def test_corridor_respects_error_threshold(self):
+        gcode = noisy_line_gcode()
+        original = move_positions(gcode)
+        for error_threshold in (0.05, 0.15, 0.5):
+            optimized = move_positions(GcodeOptimizer(algorithm="corridor").optimize_gcode(gcode, error_threshold))
+            assert len(optimized) < len(original) / 2
+            # every original point must be within error_threshold of the line replacing it
+            start, i = original[0], 0
+            for end in optimized[1:]:
+                length = math.hypot(end[0] - start[0], end[1] - start[1])
+                while original[i] != end:
+                    px, py = original[i]
+                    cross = (end[0] - start[0]) * (py - start[1]) - (end[1] - start[1]) * (px - start[0])
+                    assert abs(cross) / length <= error_threshold + 1e-9
+                    i += 1
+                start = end
+            assert original[i] == optimized[-1]
+
+    def test_corridor_close_to_exact(self):
+        gcode = synthetic_gcode()
+        exact = GcodeOptimizer().optimize_gcode(gcode).split("\n")
+        corridor = GcodeOptimizer(algorithm="corridor").optimize_gcode(gcode).split("\n")
+        assert len(exact) <= len(corridor) < 1.5 * len(exact)
+
+    def test_parallel_identical(self):
+        gcode = synthetic_gcode(n_layers=6)
+        for algorithm in ("exact", "corridor"):
+            expected = GcodeOptimizer(algorithm=algorithm).optimize_gcode(gcode)
+            for chunk_lines in (1, 150, 100000):
+                optimizer = GcodeOptimizer(algorithm=algorithm, jobs=2, chunk_lines=chunk_lines)
+                assert optimizer.optimize_gcode(gcode) == expected
+
+
+def circle_gcode(segments=90, sweep=1.5 * math.pi, relative_e=False):
+    lines = ["M83" if relative_e else "M82", "G1 Z0.2 F1200", "G1 X70 Y50 F3000"]
+    for i in range(1, segments + 1):
+        a = sweep * i / segments
+        lines.append("G1 X%.4f Y%.4f E%.5f" % (50 + 20 * math.cos(a), 50 + 20 * math.sin(a),
+                                                0.02 if relative_e else 0.02 * i))
+    lines.append("G1 X10 Y10 F6000")
+    return "\n".join(lines)
+
+
+class ArcWelderTests(unittest.TestCase):
+    def test_circle_becomes_arc(self):
+        welder = ArcWelder()
+        welded = welder.weld_gcode(circle_gcode()).split("\n")
+        assert welded == ["M82", "G1 Z0.2 F1200", "G1 X70 Y50 F3000",
+                          "G3 X50 Y30 I-20 J0 E1.8", "G1 X10 Y10 F6000"]
+        assert welder.arcs == 1
+        assert welder.bytes_saved == len(circle_gcode()) - len("\n".join(welded))
+
+    def test_relative_extrusion(self):
+        welded = ArcWelder().weld_gcode(circle_gcode(relative_e=True, sweep=-math.pi)).split("\n")
+        assert welded[3] == "G2 X30 Y50 I-20 J0 E1.8"
+
+    def test_keeps_lines_and_varying_extrusion(self):
+        lines = ["G1 X%i Y%i E%i" % (i, i % 2, i) for i in range(20)]
+        assert ArcWelder().weld_gcode("\n".join(lines)) == "\n".join(lines)
+        # alternating extrusion widths along the circle must not be averaged by an arc
+        gcode = circle_gcode(relative_e=True)
+        varying = "\n".join(line.replace("E0.02", "E0.04") if i % 2 else line
+                            for i, line in enumerate(gcode.split("\n")))
+        assert ArcWelder().weld_gcode(varying) == varying
+
+    def test_chained_after_optimizer(self):
+        gcode = synthetic_gcode()
+        welder = ArcWelder(tolerance=0.2)
+        welded = list(welder.weld_lines(GcodeOptimizer().optimize_lines(gcode.split("\n"))))
+        assert welder.arcs > 0 and welder.bytes_saved > 0
+        assert sum(len(line) + 1 for line in welded) == welder.bytes_out
+
+
+if __name__ == "__main__":
+    unittest.main()
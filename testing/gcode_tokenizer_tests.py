@@ -0,0 +1,64 @@
+import mmap
+import tempfile
+import unittest
+
+from modtpy.api.gcode_optimization import GcodeOptimizer
+from modtpy.api.gcode_tokenizer import (tokenize_line, tokenize_buffer, iter_lines, iter_text_lines, Instruction,
+                                        EMPTY, FLAG_X, FLAG_Y, FLAG_E, FLAG_F)
+from modtpy.api.utils import gcode_buffer
+
+
+class GcodeTokenizerTests(unittest.TestCase):
+    def test_move(self):
+        ins = tokenize_line("G1 X10.5 Y-2 E0.3 F1200\n")
+        assert ins == Instruction("G1", FLAG_X | FLAG_Y | FLAG_E | FLAG_F, 10.5, -2., 0., 0.3, 1200.)
+
+    def test_whitespace_and_comments(self):
+        expected = Instruction("G1", FLAG_X | FLAG_Y, 1., 2., 0., 0., 0.)
+        assert tokenize_line("G1  X1\tY2") == expected
+        assert tokenize_line("  G1 X1 Y2 ; move") == expected
+        assert tokenize_line("G1 X1 Y2 ;E5") == expected
+        assert tokenize_line("; only a comment") is EMPTY
+        assert tokenize_line("   ") is EMPTY
+
+    def test_command_normalization(self):
+        assert tokenize_line("G01 X1").command == "G1"
+        assert tokenize_line("g0 x1").command == "G0"
+        assert tokenize_line("G92 E0") == Instruction("G92", FLAG_E, 0., 0., 0., 0., 0.)
+        assert tokenize_line("M104 S200").command == "M104"
+
+    def test_compact_words(self):
+        assert tokenize_line("G1X10Y5E.5") == Instruction("G1", FLAG_X | FLAG_Y | FLAG_E, 10., 5., 0., 0.5, 0.)
+
+    def test_bytes(self):
+        for line in ("G1 X10.5 Y-2 E0.3 F1200", "G1X10Y5", "G01  X1 ; comment", "; comment"):
+            assert tokenize_line(line.encode()) == tokenize_line(line)
+
+    def test_buffer(self):
+        gcode = b"G28\nG1 X1 Y2\n\n; comment\nG1 X3"
+        assert list(iter_lines(gcode)) == [b"G28", b"G1 X1 Y2", b"", b"; comment", b"G1 X3"]
+        with tempfile.TemporaryFile() as f:
+            f.write(gcode)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                assert list(tokenize_buffer(buffer)) == [tokenize_line(line) for line in gcode.decode().split("\n")]
+
+    def test_gcode_buffer(self):
+        gcode = b"; header\r\nG28\r\nG1 X1 Y2"
+        with tempfile.TemporaryFile() as f:
+            f.write(gcode)
+            f.seek(len(b"; header\r\n"))
+            with gcode_buffer(f) as buffer:
+                assert isinstance(buffer, memoryview) and buffer.readonly
+                assert list(iter_lines(buffer)) == [b"G28\r", b"G1 X1 Y2"]
+                assert list(iter_text_lines(buffer)) == ["G28", "G1 X1 Y2"]
+
+    def test_optimizer_tolerates_double_spaces(self):
+        gcode = "G1 X0 Y0 E0\nG1  X1 Y0 E1\nG1 X2  Y0 E2\nG1 X3 Y0  E3"
+        optimized = GcodeOptimizer().optimize_gcode(gcode).split("\n")
+        # the collinear moves are merged into a single one
+        assert len(optimized) == 2 and optimized[-1] == "G1 X3.0 E3.0"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+
+from modtpy.api.jobs import JobQueue, JobState
+from modtpy.api.modt_commands import Endpoints
+from testing import dummy_usb
+
+
+def wait_until_finished(*jobs, timeout=10):
+    deadline = time.time() + timeout
+    while any(job.state not in JobState.FINISHED for job in jobs):
+        assert time.time() < deadline, "jobs didn't finish: %s" % [job.to_dict() for job in jobs]
+        time.sleep(.01)
+
+
+class JobQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.modt = dummy_usb.RecordingModt()
+        self.modt.connect()
+        self.jobs = JobQueue(self.modt, spool_dir=self.spool_dir.name)
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def test_jobs_run_in_order(self):
+        gcode = b"G1 X1 Y1\n" * 2000
+        first = self.jobs.submit(io.BytesIO(gcode), "first.gcode")
+        second = self.jobs.submit(io.BytesIO(gcode[::-1]), "second.gcode")
+        wait_until_finished(first, second)
+        assert first.state == second.state == JobState.DONE
+        assert first.finished <= second.started
+        assert first.progress == 100 and first.total == len(gcode)
+        _, uploaded = self.modt.uploaded(Endpoints.BASIC_WRITE)
+        assert uploaded.startswith(gcode) and uploaded.endswith(gcode[::-1])
+        # spool files are removed once their job is finished
+        assert os.listdir(self.spool_dir.name) == []
+
+    def test_spool(self):
+        from modtpy.api.modt import adler32_checksum
+        gcode = os.urandom(100000)
+        spool = self.jobs.spool()
+        for start in range(0, len(gcode), 4096):
+            spool.write(gcode[start:start + 4096])
+        # queued without another copy, with the checksum computed while writing
+        job = self.jobs.submit(spool, "streamed.gcode")
+        assert job.path == spool.path and job.checksum == adler32_checksum(gcode)
+        wait_until_finished(job)
+        header, uploaded = self.modt.uploaded(Endpoints.BASIC_WRITE)
+        assert uploaded == gcode and b'"adler32":%i' % job.checksum in header
+
+    def test_cancel(self):
+        self.modt.reboot_time = .2
+        running = self.jobs.submit(io.BytesIO(b"G1 X1\n" * 1000), "running.gcode")
+        queued = self.jobs.submit(io.BytesIO(b"G1 X2\n"), "queued.gcode")
+        assert self.jobs.cancel(queued.id).state == JobState.CANCELLED
+        # cancelled while the printer is reset, i.e. before anything is sent
+        self.jobs.cancel(running.id)
+        wait_until_finished(running, queued)
+        assert running.state == queued.state == JobState.CANCELLED
+        assert not any(b'"file_push"' in data for _, data in self.modt.usb.writes)
+
+    def test_cancel_before_processing(self):
+        from modtpy.api.jobs import PrintJob
+        # e.g. cancelled after the worker took the job from the queue, but before it started processing it
+        job = PrintJob("cancelled", "cancelled.gcode", os.path.join(self.spool_dir.name, "cancelled.gcode"))
+        self.jobs._jobs[job.id] = job
+        self.jobs.cancel(job.id)
+        assert self.jobs._process(job) == JobState.CANCELLED
+        assert job.state == JobState.CANCELLED and job.started is None
+
+    def test_cancel_while_preparing(self):
+        prepared = []
+
+        def prepare(job):
+            # e.g. the optimization of the job, which passes its lines through job.watch
+            for i, line in enumerate(job.watch(iter(lambda: "G1 X1", None))):
+                if i == 100:
+                    self.jobs.cancel(job.id)
+                prepared.append(line)
+
+        self.jobs.prepare = prepare
+        job = self.jobs.submit(io.BytesIO(b"G1 X1\n"), "optimized.gcode")
+        wait_until_finished(job)
+        assert job.state == JobState.CANCELLED and len(prepared) == 101
+        # the printer is only reset while preparing, as nothing has been sent afterwards
+        resets = [data for _, data in self.modt.usb.writes if b"Reset_printer" in data]
+        assert len(resets) == 1
+
+    def test_status_polled_while_preparing(self):
+        self.modt.run_status_loop()
+        polled = []
+
+        def prepare(job):
+            # prepare runs in the worker thread, the owner thread keeps polling the status meanwhile
+            snapshot = self.modt.status_snapshot
+            polled.append(self.modt.wait_for_status(snapshot, timeout=5) is not snapshot)
+            return job.path, job.checksum
+
+        self.jobs.prepare = prepare
+        job = self.jobs.submit(io.BytesIO(b"G1 X1\n"), "prepared.gcode")
+        wait_until_finished(job)
+        assert job.state == JobState.DONE and polled == [True]
+
+
+if __name__ == "__main__":
+    unittest.main()
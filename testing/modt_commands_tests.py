@@ -0,0 +1,25 @@
+import unittest
+
+from modtpy.api.modt_commands import command_indexes, get_payload, encode_command, press_button_gcode
+
+
+class CommandEncoderTests(unittest.TestCase):
+    def test_matches_get_payload(self):
+        arguments = [None, dict(interface_t=0), dict(command=[ord(c) for c in press_button_gcode] + [0]),
+                     dict(ssid="modt", values=[1.5, -2], enabled=True, nested=dict(a=None))]
+        for name in command_indexes:
+            for running_id in (1, 3, 99, 12345):
+                for args in arguments:
+                    checksum, payload = get_payload(name, running_id, args=args)
+                    header, encoded = encode_command(name, running_id, args=args)
+                    assert encoded == payload.encode(), name
+                    assert header == bytes.fromhex(checksum), name
+
+    def test_keeps_spaces_in_arguments(self):
+        header, payload = encode_command("wifi_client_connect", 1, args=dict(ssid="my network"))
+        assert b'"args":{"ssid":"my network"}' in payload
+        assert header[1] == len(payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
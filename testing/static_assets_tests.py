@@ -0,0 +1,41 @@
+import gzip
+import os
+import tempfile
+import unittest
+
+from flask import Flask
+
+from modtpy.web.static_assets import StaticAssets
+
+
+class StaticAssetsTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.script = b"const x = 1;\n" * 100
+        with open(os.path.join(self.directory.name, "app.js"), "wb") as f:
+            f.write(self.script)
+        app = Flask(__name__, static_folder=None)
+        app.add_url_rule("/static/<path:filename>", endpoint="static",
+                         view_func=StaticAssets(self.directory.name).send)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_compressed_variants(self):
+        response = self.client.get("/static/app.js", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.data) == self.script
+        assert "max-age" in response.headers["Cache-Control"] and response.headers["Vary"] == "Accept-Encoding"
+        response = self.client.get("/static/app.js")
+        assert "Content-Encoding" not in response.headers and response.data == self.script
+
+    def test_conditional(self):
+        etag = self.client.get("/static/app.js").headers["ETag"]
+        assert self.client.get("/static/app.js", headers={"If-None-Match": etag}).status_code == 304
+        assert self.client.get("/static/../app.js").status_code == 404
+        assert self.client.get("/static/missing.js").status_code == 404
+
+
+if __name__ == "__main__":
+    unittest.main()
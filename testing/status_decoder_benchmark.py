@@ -0,0 +1,24 @@
+import timeit
+
+import click
+
+from modtpy.api.utils import parse_json, RegexPrinterStatus
+from testing.status_tests import STATUS
+
+
+@click.command()
+@click.option("-n", "--number", default=10000, help="number of decoded messages per parser")
+def cli(number):
+    """ microseconds per decoded status message of the json decoder, its regex fallback and the former regex parser """
+    garbled = "\x00\x17" + STATUS[:-10]
+    parsers = (("json", lambda: parse_json(STATUS).to_dict()),
+               ("fallback", lambda: parse_json(garbled).to_dict()),
+               ("regex", lambda: RegexPrinterStatus(STATUS).to_dict()))
+    print("%10s %14s" % ("parser", "us/message"))
+    for name, parse in parsers:
+        seconds = min(timeit.repeat(parse, number=number, repeat=3))
+        print("%10s %14.1f" % (name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    cli()
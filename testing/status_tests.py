@@ -0,0 +1,56 @@
+import json
+import unittest
+
+from modtpy.api.status_history import StatusHistory
+from modtpy.api.utils import parse_json, RegexPrinterStatus
+
+STATUS = json.dumps(dict(metadata=dict(version=1, type="status"), model_name="MOD-t",
+                         status=dict(state="STATE_BUILDING", build_plate="BUILD_PLATE_LOADED", filament="LOADED",
+                                     extruder_temperature=210.5, extruder_target_temperature=210),
+                         job=dict(id="42", source="usb", progress=17, rx_progress=100, state="JOB_STATE"),
+                         time=dict(idle=0, boot=3600)))
+
+
+class StatusDecoderTests(unittest.TestCase):
+    def test_json(self):
+        status = parse_json(STATUS)
+        assert status.model_name == "MOD-t"
+        assert status.status.state == "STATE_BUILDING" and status.status.extruder_temperature == 210.5
+        assert status.job.progress == 17 and status.time.boot == 3600
+        # a state key in another section doesn't shadow the printer state
+        assert status.to_dict()["status"]["state"] == "STATE_BUILDING"
+
+    def test_same_layout_as_regex_parser(self):
+        decoded, regex = parse_json(STATUS).to_dict(), RegexPrinterStatus(STATUS).to_dict()
+        assert decoded.keys() == regex.keys()
+        for section in ("status", "job", "time"):
+            assert decoded[section].keys() == regex[section].keys()
+
+    def test_garbage_around_json(self):
+        assert parse_json("\x00\x17ab" + STATUS + "}{garbage").job.progress == 17
+
+    def test_regex_fallback(self):
+        truncated = STATUS[:STATUS.index('"time"')]
+        status = parse_json(truncated)
+        assert status.status.state == "STATE_BUILDING" and status.job.progress == "17"
+        assert parse_json("").status.state is None
+
+
+class StatusHistoryTests(unittest.TestCase):
+    def test_since(self):
+        history = StatusHistory(capacity=4)
+        status = parse_json(STATUS).to_dict()
+        for t in range(6):
+            history.append(status, t)
+        history.append(dict(status=dict(state="disconnected")), 6)
+        # the two oldest samples have been overwritten
+        assert history.since()["timestamp"] == [3, 4, 5, 6]
+        delta = history.since(4)
+        assert delta["timestamp"] == [5, 6]
+        assert delta["state"] == ["STATE_BUILDING", "disconnected"]
+        assert delta["extruder_temperature"] == [210.5, None] and delta["progress"] == [17, None]
+        assert history.since(6)["timestamp"] == []
+
+
+if __name__ == "__main__":
+    unittest.main()
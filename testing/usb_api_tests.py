@@ -1,7 +1,12 @@
 import logging
 logging.getLogger().setLevel(logging.DEBUG)
 
+import io
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
 import time
 import multiprocessing
 from testing import dummy_usb
@@ -72,6 +77,291 @@ class ModTTests(unittest.TestCase):
         modt = dummy_usb.VirtualModt
         assert modt.running_id == 5
 
+    def test_send_gcode(self):
+        from modtpy.api.modt import Endpoints, adler32_checksum
+
+        class Stream:
+            # a non-seekable upload stream
+            def __init__(self, data):
+                self.read = io.BytesIO(data).read
+
+        gcode = b"".join(b"G1 X%i Y%i E%i\n" % (i, i % 7, i) for i in range(2000))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "test.gcode")
+            with open(path, "wb") as f:
+                f.write(gcode)
+            for gcode_file in (path, io.BytesIO(gcode), Stream(gcode)):
+                modt = dummy_usb.RecordingModt()
+                modt.connect()
+                modt.send_gcode(gcode_file)
+                header, uploaded = modt.uploaded(Endpoints.BASIC_WRITE)
+                push = json.loads(header.decode())["file_push"]
+                assert uploaded == gcode
+                assert push["size"] == len(gcode) and push["adler32"] == adler32_checksum(gcode)
+
+    def test_upload_timeout(self):
+        import usb.core
+        from modtpy.api.errors import PrinterError
+
+        class TimingOutUSB(dummy_usb.RecordingUSB):
+            def write(self, endpoint, data, timeout=None):
+                if len(data) > 1024:
+                    raise usb.core.USBTimeoutError("timeout", 110, 110)
+                return super().write(endpoint, data, timeout)
+
+        modt = dummy_usb.RecordingModt(usb=TimingOutUSB())
+        modt.connect()
+        with self.assertRaises(PrinterError) as context:
+            modt.send_gcode(io.BytesIO(b"G1 X1\n" * 2000))
+        assert "timeout" in context.exception.to_dict()["error"]
+
+    def test_upload_settings(self):
+        from modtpy.api.modt import Endpoints
+        from modtpy.api.transfer import UploadSettings
+
+        gcode = b"G1 X1 Y1 E1\n" * 1000
+        modt = dummy_usb.RecordingModt()
+        modt.connect()
+        stats = modt.send_gcode(io.BytesIO(gcode), settings=UploadSettings(packets_per_write=3, drain_interval=4))
+        header, uploaded = modt.uploaded(Endpoints.BASIC_WRITE)
+        assert uploaded == gcode
+        writes = [data for ep, data in modt.usb.writes if ep == Endpoints.BASIC_WRITE]
+        assert max(map(len, writes[writes.index(header) + 1:])) == 3 * 64
+        assert stats.writes == len(gcode) // 192 + 1 and stats.drains == (stats.writes - 1) // 4
+
+    def test_prefetch(self):
+        from modtpy.api.modt import Endpoints
+        from modtpy.api.transfer import UploadSettings, iter_blocks, prefetch_blocks
+
+        gcode = os.urandom(100000)
+        assert [bytes(b) for b in prefetch_blocks(gcode, 512, 3)] == [bytes(b) for b in iter_blocks(gcode, 512)]
+        # closing the generator early stops the producer
+        blocks = prefetch_blocks(gcode, 512, 3)
+        next(blocks)
+        blocks.close()
+
+        modt = dummy_usb.RecordingModt()
+        modt.connect()
+        modt.send_gcode(io.BytesIO(gcode), settings=UploadSettings(prefetch=4))
+        assert modt.uploaded(Endpoints.BASIC_WRITE)[1] == gcode
+
+    def test_send_prepared_gcode(self):
+        from modtpy.api.modt import Endpoints
+
+        gcode = b"G1 X1 Y1 E1\n" * 1000
+        modt = dummy_usb.RecordingModt()
+        modt.connect()
+        modt.reboot_time = .5
+
+        def prepare():
+            time.sleep(.5)
+            return io.BytesIO(gcode), None
+
+        start = time.perf_counter()
+        stats = modt.send_prepared_gcode(prepare)
+        # the reboot wait overlaps with the preparation
+        assert time.perf_counter() - start < .9
+        assert modt.uploaded(Endpoints.BASIC_WRITE)[1] == gcode
+        assert {"reset", "prepare", "reset_wait", "checksum", "transfer"} <= stats.timings.keys()
+
+    def test_adaptive_drain_interval(self):
+        from modtpy.api.transfer import AdaptiveDrainInterval
+
+        # throughput peaks at an interval of 30
+        schedule = AdaptiveDrainInterval(interval=5, minimum=2, maximum=200)
+        intervals = []
+        for _ in range(40):
+            schedule.update(1000 - abs(schedule.interval - 30))
+            intervals.append(schedule.interval)
+        assert all(20 <= interval <= 40 for interval in intervals[-10:])
+
+    def test_device_session(self):
+        import usb.core
+        from modtpy.api.usb import USBDevice, DeviceSession, Mode
+
+        class Device:
+            configurations = 0
+
+            def set_configuration(self):
+                self.configurations += 1
+
+        found = []
+
+        def find(idVendor, idProduct):
+            if idProduct == Mode.OPERATE:
+                found.append(Device())
+                return found[-1]
+
+        device = USBDevice()
+        device.session = DeviceSession()
+        with mock.patch("usb.core.find", find), mock.patch("usb.util.release_interface"), \
+                mock.patch("usb.util.dispose_resources"):
+            handles = []
+            for _ in range(3):
+                with device.get_device() as dev:
+                    handles.append(dev)
+            # one handle is configured once and reused
+            assert handles[0] is handles[1] is handles[2] and handles[0].configurations == 1
+
+            with self.assertRaises(usb.core.USBError):
+                with device.get_device():
+                    raise usb.core.USBError("disconnected")
+            with device.get_device() as dev:
+                assert dev is not handles[0] and dev.configurations == 1
+
+    def test_mode_tracker(self):
+        from modtpy.api.usb import ModeTracker, Mode
+
+        with mock.patch("usb.core.find", mock.Mock(return_value=object())) as find:
+            tracker = ModeTracker(0x2b75, ttl=60, hotplug=False)
+            assert tracker.mode == tracker.mode == Mode.OPERATE
+            assert find.call_count == 1
+            tracker.invalidate()
+            find.return_value = None
+            assert tracker.mode == Mode.DISCONNECTED
+            assert find.call_count == 3
+
+    def test_read_response(self):
+        from modtpy.api.modt import ModT
+        from modtpy.api.modt_commands import get_checksum
+
+        class Device:
+            def __init__(self, *transfers):
+                self.transfers = list(transfers)
+
+            def read(self, endpoint, buffer, timeout=None):
+                # raises IndexError if the reader waits for more than has been sent
+                return dummy_usb.read_into(buffer, self.transfers.pop(0))
+
+        status = b'{"status":{"state":"STATE_IDLE"}}'
+        assert ModT._read_response(Device(status), 0x83) == status
+        # messages spanning several transfers
+        transfers = (b"x" * 16, b"y" * 16, b"z")
+        assert ModT._read_response(Device(*transfers), 0x83, read_size=16) == b"".join(transfers)
+        # complete after exactly read_size bytes, without a trailing zero length transfer
+        assert ModT._read_response(Device(b"x" * 15 + b";"), 0x81, read_size=16) == b"x" * 15 + b";"
+        payload = b"p" * 11
+        framed = bytes.fromhex(get_checksum(payload.decode())) + payload
+        assert ModT._read_response(Device(framed), 0x81, read_size=16) == framed
+
+    def test_command_channel(self):
+        import queue
+        from concurrent.futures import ThreadPoolExecutor
+        import usb.core
+        from modtpy.api.modt import Endpoints
+        from modtpy.api.modt_commands import encode_command
+
+        class Device:
+            """ answers each pair of commands in reverse order, and status requests immediately """
+
+            def __init__(self):
+                self.commands = []
+                self.replies = {Endpoints.COMMAND_READ: queue.Queue(), Endpoints.BASIC_READ: queue.Queue()}
+
+            def write(self, endpoint, data, timeout=None):
+                if endpoint == Endpoints.BASIC_WRITE:
+                    self.replies[Endpoints.BASIC_READ].put(b'{"status":{"state":"STATE_IDLE"}}')
+                elif data[:1] != b"$":
+                    self.commands.append(json.loads(data[:-1]))
+                    if len(self.commands) % 2 == 0:
+                        for command in reversed(self.commands[-2:]):
+                            payload = json.dumps(dict(transport=dict(attrs=["reply"], id=command["transport"]["id"]),
+                                                      data=command["data"]["command"]["name"])) + ";"
+                            header, _ = encode_command("transport", 0)
+                            self.replies[Endpoints.COMMAND_READ].put(header + payload.encode())
+                return len(data)
+
+            def read(self, endpoint, buffer, timeout=None):
+                try:
+                    data = self.replies[endpoint].get(timeout=timeout / 1000 if timeout is not None else 1)
+                except queue.Empty:
+                    raise usb.core.USBTimeoutError("timeout", 110, 110)
+                return dummy_usb.read_into(buffer, data)
+
+        for status_loop in (False, True):
+            modt = dummy_usb.RecordingModt(usb=Device())
+            modt.connect()
+            if status_loop:
+                # the status polls share the channel with the commands instead of waiting for them
+                modt.run_status_loop()
+            # the blocking methods of several threads are in flight at once and get their own replies
+            with ThreadPoolExecutor(3) as pool:
+                version = pool.submit(modt._exec_command, "bio_get_version")
+                status = pool.submit(modt.poll_status)
+                serial = pool.submit(modt._exec_command, "bio_get_serial")
+                version, status, serial = version.result(), status.result(), serial.result()
+            assert '"data": "bio_get_version"' in version and '"data": "bio_get_serial"' in serial
+            assert status["status"]["state"] == "STATE_IDLE"
+            assert modt.get_status()["status"]["state"] == "STATE_IDLE"
+            # the channel releases the device once it is idle
+            with modt.exclusive_device():
+                pass
+
+    def test_channel_split_reply(self):
+        import asyncio
+        import usb.core
+        from modtpy.api.channel import CommandChannel
+        from modtpy.api.modt import Endpoints
+        from modtpy.api.modt_commands import command_header
+
+        class Device:
+            """ sends the reply to the first command in two transfers with a read timeout in between """
+
+            def __init__(self):
+                self.transfers = []
+
+            def write(self, endpoint, data, timeout=None):
+                if endpoint == Endpoints.COMMAND_WRITE and data[:1] != b"$":
+                    request_id = json.loads(data[:-1])["transport"]["id"]
+                    payload = json.dumps(dict(transport=dict(attrs=["reply"], id=request_id),
+                                              data="x" * 5000)).encode() + b";"
+                    reply = command_header(len(payload)) + payload
+                    self.transfers += [reply[:4096], None, reply[4096:]]
+                return len(data)
+
+            def read(self, endpoint, buffer, timeout=None):
+                if endpoint != Endpoints.COMMAND_READ or not self.transfers or self.transfers[0] is None:
+                    if self.transfers and endpoint == Endpoints.COMMAND_READ:
+                        self.transfers.pop(0)
+                    time.sleep(timeout / 1000)
+                    raise usb.core.USBTimeoutError("timeout", 110, 110)
+                return dummy_usb.read_into(buffer, self.transfers.pop(0))
+
+        async def run():
+            async with CommandChannel(dummy_usb.RecordingModt(), Device()) as channel:
+                return await channel.command("bio_get_version")
+
+        assert json.loads(asyncio.run(run())[:-1])["data"] == "x" * 5000
+
+    def test_device_owner(self):
+        import threading
+        modt = dummy_usb.RecordingModt()
+        modt.reboot_time = .5
+        modt.connect()
+        modt.run_status_loop()
+        upload = threading.Thread(target=modt.send_gcode, args=(io.BytesIO(b"G1 X1\n" * 1000),))
+        upload.start()
+        time.sleep(.1)
+        # the reset of the upload holds the device, status readers get the latest snapshot without waiting for it
+        start = time.perf_counter()
+        for _ in range(100):
+            assert isinstance(modt.get_status(), dict)
+        assert time.perf_counter() - start < .1
+        # commands wait for the device instead of timing out on its lock
+        modt.load_filament()
+        upload.join()
+        from modtpy.api.modt_commands import Endpoints
+        commands = [data for endpoint, data in modt.usb.writes if endpoint == Endpoints.COMMAND_WRITE]
+        assert any(b"load_initiate" in data for data in commands)
+
+    def test_wait_for_status(self):
+        import threading
+        modt = dummy_usb.RecordingModt()
+        snapshot = modt.status_snapshot
+        assert modt.wait_for_status(snapshot, timeout=.01) is snapshot
+        threading.Timer(.05, modt.publish_status, args=(dict(status=dict(state="STATE_IDLE")),)).start()
+        assert modt.wait_for_status(snapshot, timeout=5).status["status"]["state"] == "STATE_IDLE"
+
     def test_set_dfu_mode(self):
         from modtpy.api.modt import ModT, Mode
         modt = ModT()
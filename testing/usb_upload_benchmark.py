@@ -0,0 +1,43 @@
+import io
+import logging
+import os
+
+import click
+
+from modtpy.api.transfer import UploadSettings
+from testing.dummy_usb import RecordingModt, SimulatedUSB
+
+
+def upload(settings, size, **device_options):
+    modt = RecordingModt(usb=SimulatedUSB(**device_options))
+    modt.connect()
+    return modt.send_gcode(io.BytesIO(os.urandom(size)), settings=settings)
+
+
+@click.command()
+@click.option("-s", "--size", default=1024 ** 2, help="number of bytes to upload")
+@click.option("-p", "--packets", default="16,40,80,160,320", help="comma separated packets per write")
+@click.option("-d", "--drain-intervals", default="5,10,20,40,80", help="comma separated writes between drains")
+@click.option("--bandwidth", default=1024 ** 2, help="bandwidth of the simulated device in bytes/s")
+@click.option("--status-every", default=16 * 1024, help="bytes received per status message of the simulated device")
+def cli(size, packets, drain_intervals, bandwidth, status_every):
+    """ throughput of fixed and adaptive upload settings against a simulated mod-t (see dummy_usb.SimulatedUSB).
+    the simulation only models the trade-off between drain latency and stalls, its optimum is not necessarily the
+    one of a real printer """
+    logging.getLogger().setLevel(logging.WARNING)
+    device_options = dict(bandwidth=bandwidth, status_every=status_every)
+
+    print("%8s %10s %10s %10s %8s" % ("packets", "drain", "adaptive", "KB/s", "drains"))
+    for packets_per_write in map(int, packets.split(",")):
+        for drain_interval in map(int, drain_intervals.split(",")):
+            stats = upload(UploadSettings(packets_per_write, drain_interval), size, **device_options)
+            print("%8i %10i %10s %10.1f %8i" % (packets_per_write, drain_interval, "no", stats.kb_per_s, stats.drains))
+        settings = UploadSettings(packets_per_write, adaptive=True)
+        stats = upload(settings, size, **device_options)
+        print("%8i %10s %10s %10.1f %8i" % (packets_per_write, "%i->%i" % (settings.drain_interval,
+                                                                           stats.drain_interval),
+                                            "yes", stats.kb_per_s, stats.drains))
+
+
+if __name__ == "__main__":
+    cli()
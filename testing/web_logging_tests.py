@@ -0,0 +1,50 @@
+import logging
+import unittest
+
+from modtpy.web.service import WebLoggingHandler, install_log_handler
+
+
+class WebLoggingHandlerTests(unittest.TestCase):
+    def setUp(self):
+        WebLoggingHandler.lines.clear()
+        self.logger = logging.getLogger("web_logging_test")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.handler = WebLoggingHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_incremental(self):
+        self.logger.info("first\nsecond")
+        lines = WebLoggingHandler.get_messages()
+        assert [line["message"] for line in lines] == ["first", "second"]
+        assert lines[1]["id"] == lines[0]["id"] + 1
+        self.logger.info("third")
+        assert [line["message"] for line in WebLoggingHandler.get_messages(after=lines[-1]["id"])] == ["third"]
+        assert WebLoggingHandler.get_messages(after=lines[-1]["id"] + 1) == []
+
+    def test_epoch(self):
+        self.logger.info("restarted")
+        last = WebLoggingHandler.get_messages()[-1]["id"]
+        assert WebLoggingHandler.get_messages(after=last + 100, epoch=WebLoggingHandler.epoch) == []
+        # sequence numbers of another process, e.g. before the printer process restarted, aren't compared
+        assert [line["message"] for line in WebLoggingHandler.get_messages(after=last + 100, epoch="other")] == \
+            ["restarted"]
+
+    def test_single_handler(self):
+        install_log_handler(self.logger)
+        self.logger.info("once")
+        assert [line["message"] for line in WebLoggingHandler.get_messages()] == ["once"]
+
+    def test_bounded(self):
+        for i in range(WebLoggingHandler.max_size + 10):
+            self.logger.info("line %i", i)
+        assert len(WebLoggingHandler.lines) == WebLoggingHandler.max_size
+        assert len(WebLoggingHandler.get_messages()) == WebLoggingHandler.initial_size
+        assert len(WebLoggingHandler.get_messages(after=0)) == WebLoggingHandler.max_size
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import json
+import logging
+import time
+from unittest import mock
+
+import click
+
+from modtpy.api.usb import Mode
+from testing.dummy_usb import read_into
+
+STATUS = json.dumps(dict(model_name="MOD-t", status=dict(state="STATE_IDLE", extruder_temperature=25,
+                                                          extruder_target_temperature=0),
+                         job=dict(progress=0), time=dict(idle=10, boot=100)))
+
+
+class FakeDevice:
+    """ answers every write with a status message """
+
+    def __init__(self):
+        self.pending = b""
+
+    def set_configuration(self):
+        pass
+
+    def write(self, endpoint, data, timeout=None):
+        self.pending = STATUS.encode()
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        # the 64 byte packets of a message arrive in a single transfer, which is ended by a short packet
+        n_read = read_into(size_or_buffer, self.pending)
+        self.pending = self.pending[n_read if isinstance(n_read, int) else len(n_read):]
+        return n_read
+
+
+@click.command()
+@click.option("-n", "--requests", default=200, help="number of status requests per configuration")
+@click.option("--enumeration-time", default=0.005, help="simulated seconds per usb bus enumeration")
+def cli(requests, enumeration_time):
+    """ time per /printer/status request with a simulated printer, with the mode read from the bus on every access
+    (as before the ModeTracker) and with the cached mode """
+    logging.getLogger().setLevel(logging.WARNING)
+    device = FakeDevice()
+
+    def find(idVendor, idProduct):
+        time.sleep(enumeration_time)
+        return device if idProduct == Mode.OPERATE else None
+
+    with mock.patch("usb.core.find", find), mock.patch("usb.util.release_interface"):
+        from modtpy.web import server
+        from modtpy.web.service import get_service
+        modt = get_service().modt
+        client = server.test_client()
+        tracker = modt.mode_tracker()
+        # hotplug events of the real bus don't apply to the simulated device
+        tracker.hotplug_active = False
+
+        print("%12s %14s %12s" % ("mode cache", "ms/request", "requests/s"))
+        for name, ttl in (("none", 0), ("ttl %gs" % tracker.ttl, tracker.ttl)):
+            tracker.ttl = ttl
+            tracker.invalidate()
+            start = time.perf_counter()
+            for _ in range(requests):
+                client.get("/printer/status")
+            seconds = time.perf_counter() - start
+            print("%12s %14.2f %12.0f" % (name, seconds / requests * 1000, requests / seconds))
+
+
+if __name__ == "__main__":
+    cli()
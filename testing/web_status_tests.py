@@ -0,0 +1,91 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from modtpy.api.errors import PrinterError
+from modtpy.api.modt import adler32_checksum
+from modtpy.web import server
+from modtpy.web.printer import controllers
+from modtpy.web.printer.controllers import status_diff
+
+
+class StatusDiffTests(unittest.TestCase):
+    def test_changes(self):
+        old = dict(status=dict(state="STATE_IDLE", extruder_temperature=20), job=dict(file="a.gcode"))
+        new = dict(status=dict(state="STATE_IDLE", extruder_temperature=21), job=dict(file="a.gcode"))
+        assert status_diff(old, new) == (dict(status=dict(extruder_temperature=21)), [])
+        assert status_diff(new, new) == ({}, [])
+
+    def test_null_and_removed(self):
+        # None is a value like any other, removed entries are listed by their key path
+        old = dict(job=dict(file="a.gcode", progress=50), model_name="MOD-t")
+        new = dict(job=dict(file=None))
+        diff, removed = status_diff(old, new)
+        assert diff == dict(job=dict(file=None))
+        assert sorted(removed) == [["job", "progress"], ["model_name"]]
+
+
+class StatusRouteTests(unittest.TestCase):
+    def test_status_without_logs(self):
+        service = mock.Mock()
+        service.mode.return_value = "operate"
+        service.status.return_value = dict(status=dict(state="STATE_IDLE"))
+        with mock.patch.object(controllers, "get_service", return_value=service):
+            payload = server.test_client().get("/printer/status").get_json()
+        # the logs are fetched incrementally from /printer/logs instead
+        assert payload == dict(mode="operate", status=dict(status=dict(state="STATE_IDLE")))
+        service.logs.assert_not_called()
+
+
+class JobRoutesTests(unittest.TestCase):
+    def test_unknown_job(self):
+        service = mock.Mock()
+        service.job.side_effect = service.cancel_job.side_effect = PrinterError("no job x", status_code=404)
+        with mock.patch.object(controllers, "get_service", return_value=service):
+            client = server.test_client()
+            assert client.get("/printer/jobs/x").status_code == 404
+            response = client.post("/printer/jobs/x/cancel")
+            assert response.status_code == 404 and response.get_json()["message"] == "no job x"
+
+
+class UploadRouteTests(unittest.TestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.service = mock.Mock()
+        self.service.spool_dir.return_value = self.spool_dir.name
+        self.service.submit_job.side_effect = lambda job_id, *args, **kwargs: dict(id=job_id)
+        patcher = mock.patch.object(controllers, "get_service", return_value=self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.test_client()
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def upload(self, **data):
+        return self.client.post("/printer/upload-gcode", data=data, content_type="multipart/form-data")
+
+    def test_streamed_to_spool(self):
+        gcode = b"G1 X1 Y1\n" * 10000
+        response = self.upload(file=(io.BytesIO(gcode), "part.gcode"), optimize="false")
+        assert response.status_code == 202
+        job_id, path, filename = self.service.submit_job.call_args.args
+        assert response.get_json()["job"]["id"] == job_id and filename == "part.gcode"
+        # the upload is spooled with its checksum, ready for the job queue
+        assert os.path.dirname(path) == self.spool_dir.name
+        with open(path, "rb") as f:
+            assert f.read() == gcode
+        assert self.service.submit_job.call_args.kwargs["checksum"] == adler32_checksum(gcode)
+
+    def test_spool_discarded_on_error(self):
+        response = self.upload(file=(io.BytesIO(b"G1 X1\n"), "part.stl"))
+        assert "error" in response.get_json()
+        assert self.upload(optimize="false").status_code == 400
+        self.service.submit_job.assert_not_called()
+        assert os.listdir(self.spool_dir.name) == []
+
+
+if __name__ == "__main__":
+    unittest.main()